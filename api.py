@@ -0,0 +1,297 @@
+import argparse
+import math
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.ioloop
+import tornado.web
+
+from cube import load_cube
+from dataset import LateData, Predict, StationData, arrival_station_list
+from metrics import METRICS, count, span
+from registry import DELAY_MODEL, MODELS_DIR, ModelRegistry
+from regression import TRAIN_SHARE
+from routes import RouteIndex
+from storage import CSV_FILE, STORE_DIR, data_fingerprint, load_dataset
+
+PORT = 8888
+# Threads running the queries, the event loop only parses and answers requests.
+WORKERS = 4
+# Results kept for every client (the least recently used are dropped).
+RESULT_CACHE_SIZE = 1024
+
+# Default date range, the one of the dashboard.
+FIRST_MONTH = "2018-01"
+LAST_MONTH = "2024-12"
+MONTH = re.compile(r"\d{4}-\d{2}")
+
+# Columns read by the route queries, the station and delay totals come from the
+# cube (see cube.py).
+PRED_COLUMNS = [
+    "Departure station",
+    "Arrival station",
+    "Average journey time",
+    "Number of scheduled trains",
+    "Number of trains delayed at departure",
+]
+
+
+class NoDataError(Exception):
+    pass
+
+
+# The route has trains but too few rows with both counts to fit its model.
+class NotEnoughDataError(Exception):
+    pass
+
+
+# Rows of a frame as JSON objects (missing values as null).
+def records(df):
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+# Number as JSON: NaN and infinities are not valid JSON, they are null.
+def number(value):
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+# The analytics of dataset.py on the cleaned data, shared by every request:
+# the dataset, the cube, the route index and the model registry are loaded once
+# and again only when the data changes (see storage.data_fingerprint), the
+# results are kept in an LRU cache keyed on the version of the data.
+class Analytics:
+    def __init__(
+        self,
+        store=STORE_DIR,
+        csv_file=CSV_FILE,
+        models_dir=MODELS_DIR,
+        cache_size=RESULT_CACHE_SIZE,
+    ):
+        self.store = store
+        self.csv_file = csv_file
+        self.registry = ModelRegistry(models_dir, store, csv_file)
+        self.cache_size = cache_size
+        self.version = None
+        self.loaded = None
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Version of the data and what is loaded from it.
+    def data(self):
+        version = data_fingerprint(self.store, self.csv_file)
+        if version is None:
+            raise NoDataError("No cleaned dataset, run incremental.py first.")
+        with self.lock:
+            if version != self.version:
+                with span("load dataset", columns=PRED_COLUMNS):
+                    csv = load_dataset(
+                        PRED_COLUMNS,
+                        store=self.store,
+                        csv_file=self.csv_file,
+                        mapped=True,
+                    )
+                with span("RouteIndex"):
+                    routes = RouteIndex(csv)
+                with span("load totals"):
+                    cube = load_cube(self.store, self.csv_file)
+                self.loaded = {"csv": csv, "routes": routes, "cube": cube}
+                self.version = version
+                self.results.clear()
+            return version, self.loaded
+
+    # Result of compute(loaded data, *params), computed once per version of the
+    # data. Two requests arriving together may both compute it.
+    def cached(self, name, compute, *params):
+        version, loaded = self.data()
+        key = (version, name) + params
+        count("cache_requests", cache="api")
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return self.results[key]
+            self.misses += 1
+        count("cache_misses", cache="api")
+        with span(name, inputs=params):
+            result = compute(loaded, *params)
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > self.cache_size:
+                self.results.popitem(last=False)
+        return result
+
+    # Scheduled, cancelled and late trains per station ("departure", "arrival")
+    # or per pair ("od") over a range of months, for some stations or all of them.
+    def stations(self, dates, stations=(), by="departure"):
+        return self.cached("stations", _stations, dates, stations, by)
+
+    # Delayed trains by duration and average delay causes per departure station.
+    def causes(self, dates, stations=(), weighted=False):
+        return self.cached("causes", _causes, dates, stations, weighted)
+
+    # Arrival stations of a departure station, or every departure station.
+    def routes(self, departure=None):
+        return self.cached("routes", _routes, departure)
+
+    # Prediction of the prediction page for one route, None if it has no trains.
+    def predict(self, departure, arrival):
+        return self.cached("predict", self._predict, departure, arrival)
+
+    def _predict(self, loaded, departure, arrival):
+        csv, routes = loaded["csv"], loaded["routes"]
+        if (departure, arrival) not in routes.slices:
+            return None
+        predict = Predict(csv, [arrival], [departure], routes)
+        # the model is fitted on the first 80% of the rows (see PolyFit)
+        rows = predict.csv[list(DELAY_MODEL[:2])].dropna()
+        if int(len(rows) * TRAIN_SHARE) == 0:
+            raise NotEnoughDataError("Not enough trains on this route for a model")
+        models = self.registry.get(*DELAY_MODEL, csv=csv)
+        degree = models.degree(departure, arrival)
+        fit = predict.fit(*DELAY_MODEL[:2], degree, models=models)
+        nb_trains = predict.moy("Number of scheduled trains")
+        low, high = fit.interval(nb_trains)
+        return {
+            "departure": departure,
+            "arrival": arrival,
+            "average journey time": number(predict.moy("Average journey time")),
+            "scheduled trains": number(nb_trains),
+            "delayed at departure": number(fit.model(nb_trains)),
+            "low": number(max(low[0], 0)),
+            "high": number(max(high[0], 0)),
+            "degree": degree,
+            "r2": number(fit.r2),
+            "rmse": number(fit.rmse),
+        }
+
+
+def _stations(loaded, dates, stations, by):
+    data = StationData.from_cube(loaded["cube"], list(dates), by)
+    df = data.df
+    if stations:
+        df = df[df[data.keys[0]].isin(stations)]
+    return {"dates": list(dates), "by": by, "stations": records(df)}
+
+
+def _causes(loaded, dates, stations, weighted):
+    df = LateData.from_cube(loaded["cube"], list(dates), weighted).df
+    if stations:
+        df = df[df["station"].isin(stations)]
+    return {"dates": list(dates), "weighted": weighted, "stations": records(df)}
+
+
+def _routes(loaded, departure):
+    routes = loaded["routes"]
+    if departure is None:
+        return {"departures": sorted(routes.arrivals)}
+    arrivals = arrival_station_list(loaded["csv"], [departure], routes)
+    return {"departure": departure, "arrivals": arrivals}
+
+
+# Every query runs in the worker pool, errors are answered as JSON.
+class QueryHandler(tornado.web.RequestHandler):
+    def initialize(self, analytics, pool):
+        self.analytics = analytics
+        self.pool = pool
+
+    async def run(self, function, *args):
+        loop = tornado.ioloop.IOLoop.current()
+        try:
+            result = await loop.run_in_executor(self.pool, function, *args)
+        except NoDataError as e:
+            raise tornado.web.HTTPError(503, reason=str(e))
+        except NotEnoughDataError as e:
+            raise tornado.web.HTTPError(422, reason=str(e))
+        if result is None:
+            raise tornado.web.HTTPError(404, reason="No train on this route")
+        self.write(result)
+
+    def dates(self):
+        dates = (
+            self.get_argument("start", FIRST_MONTH),
+            self.get_argument("end", LAST_MONTH),
+        )
+        if not all(MONTH.fullmatch(month) for month in dates):
+            raise tornado.web.HTTPError(400, reason="Months are written YYYY-MM")
+        return dates
+
+    def stations(self):
+        return tuple(self.get_arguments("station"))
+
+    def write_error(self, status_code, **kwargs):
+        error = kwargs.get("exc_info", (None, None))[1]
+        message = getattr(error, "log_message", None) or self._reason
+        self.finish({"error": message, "status": status_code})
+
+
+class StationsHandler(QueryHandler):
+    async def get(self):
+        by = self.get_argument("by", "departure")
+        if by not in ("departure", "arrival", "od"):
+            raise tornado.web.HTTPError(400, reason="by is departure, arrival or od")
+        await self.run(self.analytics.stations, self.dates(), self.stations(), by)
+
+
+class CausesHandler(QueryHandler):
+    async def get(self):
+        weighted = self.get_argument("weighted", "false").lower() in ("1", "true")
+        await self.run(self.analytics.causes, self.dates(), self.stations(), weighted)
+
+
+class RoutesHandler(QueryHandler):
+    async def get(self):
+        await self.run(self.analytics.routes, self.get_argument("departure", None))
+
+
+class PredictHandler(QueryHandler):
+    async def get(self):
+        departure = self.get_argument("departure")
+        arrival = self.get_argument("arrival")
+        await self.run(self.analytics.predict, departure, arrival)
+
+
+# Timings and cache counters of the process, in the Prometheus text format.
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(METRICS.prometheus())
+
+
+# The application, with its own analytics and worker pool unless they are given
+# (a test can pass an Analytics on a small store).
+def make_app(analytics=None, pool=None, workers=WORKERS):
+    options = {
+        "analytics": analytics or Analytics(),
+        "pool": pool or ThreadPoolExecutor(workers),
+    }
+    return tornado.web.Application(
+        [
+            (r"/stations", StationsHandler, options),
+            (r"/causes", CausesHandler, options),
+            (r"/routes", RoutesHandler, options),
+            (r"/predict", PredictHandler, options),
+            (r"/metrics", MetricsHandler),
+        ]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve the station, delay and prediction analytics as JSON."
+    )
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--store", default=STORE_DIR)
+    parser.add_argument("--csv", default=CSV_FILE)
+    parser.add_argument("--models", default=MODELS_DIR)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    app = make_app(Analytics(args.store, args.csv, args.models), workers=args.workers)
+    app.listen(args.port)
+    print(f"Listening on http://localhost:{args.port}")
+    tornado.ioloop.IOLoop.current().start()
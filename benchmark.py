@@ -0,0 +1,219 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cleaning import CanonicalCache, clean
+from cube import build_cube
+from dataset import FIT_CACHE, LateData, Predict, StationData, arrival_station_list
+from incremental import read_raw
+from routes import RouteIndex
+from storage import compact
+from synthetic import write_dataset
+
+SIZES = {"10k": 10_000, "1M": 1_000_000, "10M": 10_000_000}
+DATA_DIR = "bench_data"
+BASELINE_FILE = "benchmark_baseline.json"
+# A stage is reported slower (or using more memory) above baseline * (1 + TOLERANCE).
+TOLERANCE = 0.25
+# Times under MIN_SECONDS and peaks under MIN_PEAK_MB are not compared, they are
+# mostly noise.
+MIN_SECONDS = 0.01
+MIN_PEAK_MB = 1.0
+
+DATES = ["2018-01", "2024-12"]
+DELAY = ("Number of scheduled trains", "Number of trains delayed at departure")
+# Routes predicted by the Predict stage, the ones with the most rows.
+PREDICT_ROUTES = 20
+
+
+# Stages of the benchmark, in order: each one takes the state of the previous ones
+# and returns the number of items it processed (rows, queries or routes).
+def _clean(state):
+    # a new cache on each run: every run matches the raw names against the stations
+    cache = CanonicalCache(None)
+    parts = [compact(clean(raw, cache)[0]) for raw in read_raw([state["path"]])]
+    state["csv"] = pd.concat(parts, ignore_index=True)
+    return len(state["csv"])
+
+
+def _station_data(state):
+    StationData(state["csv"], DATES)
+    return len(state["csv"])
+
+
+def _late_data(state):
+    LateData(state["csv"], DATES)
+    return len(state["csv"])
+
+
+def _build_cube(state):
+    build_cube(state["csv"])
+    return len(state["csv"])
+
+
+def _route_index(state):
+    state["routes"] = RouteIndex(state["csv"])
+    return len(state["csv"])
+
+
+def _arrival_station_list(state):
+    departures = list(state["routes"].arrivals)
+    for departure in departures:
+        arrival_station_list(state["csv"], [departure])
+    return len(departures)
+
+
+def _arrival_station_list_index(state):
+    departures = list(state["routes"].arrivals)
+    for departure in departures:
+        arrival_station_list(state["csv"], [departure], state["routes"])
+    return len(departures)
+
+
+def _predict(state):
+    routes = state["routes"]
+    busiest = sorted(routes.slices, key=lambda pair: -len(routes.pair_rows(*pair)))
+    FIT_CACHE.clear()
+    for departure, arrival in busiest[:PREDICT_ROUTES]:
+        predict = Predict(state["csv"], [arrival], [departure], routes)
+        predict.model(*DELAY)
+        predict.r2(*DELAY)
+        predict.rmse(*DELAY)
+    return min(len(busiest), PREDICT_ROUTES)
+
+
+STAGES = [
+    ("clean", "rows", _clean),
+    ("StationData", "rows", _station_data),
+    ("LateData", "rows", _late_data),
+    ("build_cube", "rows", _build_cube),
+    ("RouteIndex", "rows", _route_index),
+    ("arrival_station_list", "queries", _arrival_station_list),
+    ("arrival_station_list (index)", "queries", _arrival_station_list_index),
+    ("Predict", "routes", _predict),
+]
+
+
+# Best time of repeat runs of a stage, then the peak of the memory it allocates
+# in one more run with tracemalloc (kept apart, tracing slows the code down).
+def measure(function, state, repeat=1):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = function(state)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    seconds = min(times)
+    return {
+        "seconds": seconds,
+        "items": items,
+        "per_second": items / seconds if seconds else None,
+        "peak_mb": peak / 2**20,
+    }
+
+
+def run(size, seed=0, repeat=1, data_dir=DATA_DIR):
+    path = write_dataset(data_dir, SIZES[size], seed)
+    results = {}
+    state = {"path": path}
+    for name, unit, function in STAGES:
+        results[name] = dict(measure(function, state, repeat), unit=unit)
+        print(
+            f"{size:>4} {name:<30} {results[name]['seconds']:9.3f} s "
+            f"{results[name]['peak_mb']:9.1f} MB"
+        )
+    return results
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+# Table of every stage against the baseline. Returns the table and the stages
+# that are slower or use more memory than the tolerance allows.
+def compare(results, baseline, tolerance=TOLERANCE):
+    rows = []
+    regressions = []
+    for size, stages in results.items():
+        for name, result in stages.items():
+            before = baseline.get("results", {}).get(size, {}).get(name)
+            row = {
+                "size": size,
+                "stage": name,
+                "seconds": result["seconds"],
+                "peak MB": result["peak_mb"],
+            }
+            if before is not None:
+                row["time ratio"] = result["seconds"] / before["seconds"]
+                row["memory ratio"] = result["peak_mb"] / max(before["peak_mb"], 1e-9)
+                slower = (
+                    result["seconds"] > MIN_SECONDS
+                    and row["time ratio"] > 1 + tolerance
+                )
+                bigger = (
+                    result["peak_mb"] > MIN_PEAK_MB
+                    and row["memory ratio"] > 1 + tolerance
+                )
+                if slower or bigger:
+                    regressions.append((size, name))
+            rows.append(row)
+    return pd.DataFrame(rows), regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the cleaning and the analytics on synthetic datasets."
+    )
+    parser.add_argument("--size", action="append", choices=list(SIZES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--output", help="also write the results in this file")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="replace the baseline"
+    )
+    args = parser.parse_args()
+
+    report = {
+        "environment": environment(),
+        "seed": args.seed,
+        "results": {
+            size: run(size, args.seed, args.repeat, args.data_dir)
+            for size in args.size or ["10k"]
+        },
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=1), encoding="utf-8")
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(report, indent=1), encoding="utf-8")
+        print(f"Baseline saved in {baseline_path}")
+    elif baseline_path.exists():
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+        table, regressions = compare(report["results"], baseline, args.tolerance)
+        print(table.to_string(index=False, float_format="{:.3f}".format))
+        if baseline["environment"] != report["environment"]:
+            print("The baseline was recorded in another environment.")
+        if regressions:
+            print("Regressions:", *(f"\n  {size} {name}" for size, name in regressions))
+            raise SystemExit(1)
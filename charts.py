@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from metrics import count, span
+
+# Chart backends of the dashboard:
+# - "matplotlib": charts are rendered by the server, sent as PNG images
+# - "vega": only the aggregated data is sent, the browser draws the charts with
+#   Vega-Lite (tooltips, zoom and pan without a rerun)
+# Chosen per deployment with the TARDIS_CHARTS environment variable.
+CHART_BACKENDS = {"matplotlib": "png", "vega": "vega"}
+CHART_BACKEND = os.environ.get("TARDIS_CHARTS", "matplotlib")
+if CHART_BACKEND not in CHART_BACKENDS:
+    raise ValueError(
+        f"TARDIS_CHARTS must be one of {list(CHART_BACKENDS)}, not {CHART_BACKEND!r}"
+    )
+
+# Memory used by the rendered charts kept by default.
+CHART_CACHE_BYTES = 64 * 2**20
+# Same resolution as st.pyplot.
+CHART_DPI = 200
+
+
+# Renders a matplotlib figure in an image (png or svg) and releases the figure.
+def figure_bytes(fig, fmt="png", dpi=CHART_DPI):
+    buffer = BytesIO()
+    try:
+        fig.savefig(buffer, format=fmt, dpi=dpi, bbox_inches="tight")
+    finally:
+        fig.clear()
+    return buffer.getvalue()
+
+
+# Content sent to the browser for a chart: the image of a matplotlib figure, or
+# the Vega-Lite specification (JSON, data included) of an Altair chart.
+def chart_bytes(chart, fmt="png"):
+    if fmt == "vega":
+        return chart.to_json().encode("utf-8")
+    return figure_bytes(chart, fmt)
+
+
+# Rendered charts kept in memory, up to max_bytes: the least recently used ones
+# are dropped first. The key of a chart is made of its type and everything it
+# depends on (data version, dates, stations, lang ...), so a chart seen before
+# is served without running matplotlib. Shared by the threads of the server.
+class ChartCache:
+    def __init__(self, max_bytes=CHART_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.images = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        if len(image) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.images:
+                self.size -= len(self.images.pop(key))
+            self.images[key] = image
+            self.size += len(image)
+            while self.size > self.max_bytes:
+                _, old = self.images.popitem(last=False)
+                self.size -= len(old)
+
+    # Image (or Vega-Lite specification) of the chart of this key, drawn by draw()
+    # only if it isn't cached. Returns None if draw() has no chart, nothing is
+    # kept then.
+    # The key is the name of the chart followed by its inputs.
+    def render(self, key, draw, fmt="png"):
+        name, inputs = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        key = (key, fmt)
+        count("cache_requests", cache="charts")
+        image = self.get(key)
+        if image is None:
+            count("cache_misses", cache="charts")
+            with span(f"render {name}", inputs=inputs, format=fmt):
+                chart = draw()
+                if chart is None:
+                    return None
+                image = chart_bytes(chart, fmt)
+            self.put(key, image)
+        return image
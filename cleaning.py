@@ -0,0 +1,267 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import Levenshtein as lev
+
+from stations import SERVICES, STATIONS
+from storage import temp_path
+
+CACHE_FILE = "canonical_cache.json"
+
+COMMENT_COLUMNS = [
+    "Cancellation comments",
+    "Departure delay comments",
+    "Arrival delay comments",
+]
+
+PCT_PASSENGER = (
+    "Pct delay due to passenger handling (crowding, disabled persons, connections)"
+)
+
+# Validation table of every numeric column, in the order the columns are cleaned.
+# - type: int columns also reject any value with decimals
+# - min / max: values strictly lower / higher are rejected
+# - exclude: values known to be wrong
+# - not_above: the value can't be higher than the sum of these (already cleaned) columns
+COLUMN_RULES = {
+    "Average journey time": {"type": float, "min": 0, "max": 1500},
+    "Number of scheduled trains": {"type": int, "min": 0},
+    "Number of cancelled trains": {
+        "type": int,
+        "min": 0,
+        "not_above": ["Number of scheduled trains"],
+    },
+    "Number of trains delayed at departure": {
+        "type": int,
+        "min": 0,
+        "not_above": ["Number of scheduled trains"],
+    },
+    "Average delay of late trains at departure": {
+        "type": float,
+        "min": 0,
+        "exclude": [118.28872062060988],
+    },
+    "Average delay of all trains at departure": {"type": float},
+    "Number of trains delayed at arrival": {
+        "type": int,
+        "min": 0,
+        "not_above": ["Number of scheduled trains"],
+    },
+    "Average delay of late trains at arrival": {"type": float, "min": 0, "max": 330},
+    "Average delay of all trains at arrival": {"type": float},
+    "Number of trains delayed > 15min": {
+        "type": int,
+        "not_above": [
+            "Number of trains delayed at departure",
+            "Number of trains delayed at arrival",
+        ],
+    },
+    "Average delay of trains > 15min (if competing with flights)": {
+        "type": float,
+        "max": 330,
+    },
+    "Number of trains delayed > 30min": {
+        "type": int,
+        "not_above": ["Number of trains delayed > 15min"],
+    },
+    "Number of trains delayed > 60min": {
+        "type": int,
+        "not_above": ["Number of trains delayed > 30min"],
+    },
+    "Pct delay due to external causes": {"type": float, "min": 0, "max": 100},
+    "Pct delay due to infrastructure": {"type": float, "min": 0, "max": 100},
+    "Pct delay due to traffic management": {"type": float, "min": 0, "max": 99},
+    "Pct delay due to rolling stock": {"type": float, "min": 0, "max": 99},
+    "Pct delay due to station management and equipment reuse": {
+        "type": float,
+        "min": 0,
+        "max": 100,
+    },
+    PCT_PASSENGER: {"type": float, "min": 0, "max": 100},
+}
+
+
+# Persisted raw -> canonical lookup shared between cleaning runs.
+# Entries are grouped by a key derived from the candidate list and the cutoff,
+# so changing the list of stations never reuses stale answers.
+# With path=None the cache starts empty and is only kept in memory.
+class CanonicalCache:
+    def __init__(self, path=CACHE_FILE):
+        self.path = None if path is None else Path(path)
+        self.entries = {}
+        self.dirty = False
+        if self.path is None:
+            return
+        if self.path.exists() and self.path.stat().st_size > 0:
+            try:
+                self.entries = json.loads(self.path.read_text(encoding="utf-8"))
+            except json.JSONDecodeError:
+                self.entries = {}
+
+    @staticmethod
+    def namespace(choices, cutoff, default):
+        key = json.dumps([list(choices), cutoff, default], ensure_ascii=False)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    def table(self, choices, cutoff, default):
+        return self.entries.setdefault(self.namespace(choices, cutoff, default), {})
+
+    def save(self):
+        if not self.dirty or self.path is None:
+            return
+        tmp = temp_path(self.path)
+        tmp.write_text(
+            json.dumps(self.entries, ensure_ascii=False, indent=1), encoding="utf-8"
+        )
+        tmp.replace(self.path)
+        self.dirty = False
+
+
+# Returns the closest candidate of a raw value with Levenshtein's ratio.
+# A candidate has to score strictly above the cutoff, ties keep the first one.
+def closest(value, choices, cutoff=0.0, default=""):
+    best = default
+    best_score = cutoff
+    for choice in choices:
+        score = lev.ratio(value, choice)
+        if score > best_score:
+            best_score = score
+            best = choice
+    return best
+
+
+# Replaces every value of a column by its closest candidate.
+# Each distinct raw spelling is resolved only once (or read back from the cache)
+# and the answers are written back with a single take over the factorized codes.
+# Missing values are mapped to the default.
+def canonicalize(series, choices, cutoff=0.0, default="", cache=None):
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    known = cache.table(choices, cutoff, default) if cache is not None else {}
+
+    resolved = np.empty(len(uniques) + 1, dtype=object)
+    for i, raw in enumerate(uniques):
+        raw = str(raw)
+        if raw not in known:
+            known[raw] = closest(raw, choices, cutoff, default)
+            if cache is not None:
+                cache.dirty = True
+        resolved[i] = known[raw]
+    resolved[-1] = default
+
+    return pd.Series(resolved[codes], index=series.index, name=series.name)
+
+
+# The date format must be %Y-%m, wrong delimiters are replaced by a '-'.
+# Dates before 2015 or after today are removed.
+# Only the distinct raw values are parsed.
+def clean_date(series):
+    codes, uniques = pd.factorize(series.astype(str))
+    uniques = pd.Series(uniques).str.replace(r"(\d{4})\w(\d{2})", r"\1-\2", regex=True)
+    dates = pd.to_datetime(uniques, errors="coerce", format="%Y-%m")
+    today = pd.to_datetime("today").normalize()
+    dates[(dates < "2015-01") | (dates > today)] = pd.NaT
+    return pd.Series(dates.to_numpy()[codes], index=series.index, name=series.name)
+
+
+def clean_service(series, cache=None):
+    series = series.astype("string").astype(str).str.upper()
+    return canonicalize(series, SERVICES, cutoff=0.7, cache=cache)
+
+
+# Station names that contain numbers are removed before looking for the closest station.
+def clean_station(series, cache=None):
+    series = series.astype("string")
+    series = series.mask(series.str.contains(r".*\d.*", na=False))
+    return canonicalize(series.str.upper(), STATIONS, cache=cache)
+
+
+# Builds the checks of one column, each one returns the mask of rejected values.
+def _checks(rule, cleaned):
+    checks = [("numeric", np.isnan)]
+    if rule["type"] is int:
+        checks.append(("integer", lambda v: v % 1 != 0))
+    if "min" in rule:
+        checks.append(("min", lambda v: v < rule["min"]))
+    if "max" in rule:
+        checks.append(("max", lambda v: v > rule["max"]))
+    if "exclude" in rule:
+        checks.append(("exclude", lambda v: np.isin(v, rule["exclude"])))
+    if "not_above" in rule:
+        checks.append(
+            ("not_above", lambda v: v > sum(cleaned[ref] for ref in rule["not_above"]))
+        )
+    return checks
+
+
+# Applies every rule of the table to the dataframe.
+# Each column is parsed once with pd.to_numeric, the rules run on the resulting
+# float array and rejected values are replaced by missing values.
+# Returns the cleaned dataframe and the number of values dropped by each rule
+# with the time it took.
+def validate(csv, rules=COLUMN_RULES):
+    cleaned = {}
+    report = []
+    for column, rule in rules.items():
+        if column not in csv:
+            continue
+        start = time.perf_counter()
+        raw = csv[column]
+        values = pd.to_numeric(raw, errors="coerce").to_numpy(
+            dtype="float64", na_value=np.nan
+        )
+        for ref in rule.get("not_above", []):
+            if ref not in cleaned:
+                cleaned[ref] = pd.to_numeric(csv[ref], errors="coerce").to_numpy(
+                    dtype="float64", na_value=np.nan
+                )
+        report.append([column, "parse", 0, time.perf_counter() - start])
+
+        valid = raw.notna().to_numpy()
+        for name, check in _checks(rule, cleaned):
+            start = time.perf_counter()
+            with np.errstate(invalid="ignore"):
+                rejected = check(values) & valid
+            valid &= ~rejected
+            report.append(
+                [column, name, int(rejected.sum()), time.perf_counter() - start]
+            )
+
+        values[~valid] = np.nan
+        cleaned[column] = values
+        csv[column] = pd.Series(values, index=csv.index).astype(
+            "Int64" if rule["type"] is int else "Float64"
+        )
+
+    report = pd.DataFrame(report, columns=["column", "rule", "rejected", "seconds"])
+    return csv, report
+
+
+# Total percentage of the delay causes, any total out of [95, 105] is removed.
+def add_total_pct(csv):
+    total = (
+        csv[PCT_PASSENGER]
+        + csv["Pct delay due to station management and equipment reuse"]
+        + csv["Pct delay due to rolling stock"]
+        + csv["Pct delay due to traffic management"]
+        + csv["Pct delay due to infrastructure"]
+        + csv["Pct delay due to external causes"]
+    )
+    total[(total > 105) | (total < 95)] = np.nan
+    csv["Total Pct"] = total
+    return csv
+
+
+# Every cleaning step that only looks at one row at a time, in the notebook order.
+# Duplicates and sorting are left to the caller.
+def clean(csv, cache=None):
+    csv = csv.drop(columns=COMMENT_COLUMNS, errors="ignore")
+    csv["Date"] = clean_date(csv["Date"])
+    csv["Service"] = clean_service(csv["Service"], cache)
+    csv["Departure station"] = clean_station(csv["Departure station"], cache)
+    csv["Arrival station"] = clean_station(csv["Arrival station"], cache)
+    csv, report = validate(csv)
+    return add_total_pct(csv), report
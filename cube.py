@@ -0,0 +1,310 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from stations import STATIONS
+from storage import (
+    CSV_FILE,
+    STORE_DIR,
+    compact,
+    data_fingerprint,
+    is_undated,
+    load_dataset,
+    load_manifest,
+    read_partitions,
+    temp_path,
+)
+
+CUBE_FILE = "cube.npz"
+# Bumped when the measures change, so that old cube files are built again.
+CUBE_VERSION = 2
+
+STATION_COUNTS = [
+    "Number of scheduled trains",
+    "Number of cancelled trains",
+    "Number of trains delayed at departure",
+]
+
+LATE_COUNTS = [
+    "Number of trains delayed at arrival",
+    "Number of trains delayed > 15min",
+    "Number of trains delayed > 30min",
+    "Number of trains delayed > 60min",
+]
+
+LATE_CAUSES = [
+    "Pct delay due to passenger handling (crowding, disabled persons, connections)",
+    "Pct delay due to station management and equipment reuse",
+    "Pct delay due to rolling stock",
+    "Pct delay due to traffic management",
+    "Pct delay due to infrastructure",
+    "Pct delay due to external causes",
+]
+
+CUBE_COLUMNS = (
+    ["Date", "Departure station", "Arrival station"]
+    + STATION_COUNTS
+    + LATE_COUNTS
+    + LATE_CAUSES
+    + ["Total Pct"]
+)
+
+# Measures of each grouping, all of them can be added from one month to another.
+# - "station rows" / "late rows": rows that have every station / delay count
+# - "pct rows": rows of "late rows" that have the delay causes ("Total Pct" set)
+# - "pct weight": trains delayed at arrival of the "pct rows"
+# - "sum <cause>" / "weighted <cause>": sum of the cause percentages of the
+#   "pct rows", as they are or weighted by the trains delayed at arrival
+STATION_MEASURES = ["station rows"] + STATION_COUNTS
+DEPARTURE_MEASURES = (
+    STATION_MEASURES
+    + ["late rows"]
+    + LATE_COUNTS
+    + ["pct rows", "pct weight"]
+    + ["sum " + cause for cause in LATE_CAUSES]
+    + ["weighted " + cause for cause in LATE_CAUSES]
+)
+
+GROUPINGS = {
+    "departure": (["Departure station"], DEPARTURE_MEASURES),
+    "arrival": (["Arrival station"], STATION_MEASURES),
+    "od": (["Departure station", "Arrival station"], STATION_MEASURES),
+}
+
+
+# Monthly totals of the cleaned data per departure station, per arrival station
+# and per departure/arrival pair, kept as cumulative sums along the months:
+# sums[g][i] is the total of the months before months[i], so the total of any
+# range of months is the difference of two rows, whatever the size of the data.
+# A cube of the store also keeps the cleaning signature and the hashes of the
+# months it was built from (partitions), to be updated month by month.
+class Cube:
+    def __init__(self, months, keys, sums, key=None, partitions=None):
+        self.months = np.asarray(months, dtype=str)
+        self.keys = keys
+        self.sums = sums
+        self.key = key
+        self.partitions = partitions
+
+    # Total of every measure of a grouping over the months of [date[0], date[1]]
+    # ("YYYY-MM"), only for the stations (or pairs) that have rows in the range.
+    # Stations are in the order of the station list.
+    def totals(self, date, by="departure"):
+        columns, measures = GROUPINGS[by]
+        start = np.searchsorted(self.months, date[0], side="left")
+        end = np.searchsorted(self.months, date[1], side="right")
+        start = min(start, end)
+        values = self.sums[by][end] - self.sums[by][start]
+        df = pd.DataFrame(values, columns=measures)
+        keys = self.keys[by]
+        for i, column in enumerate(columns):
+            df.insert(i, column, [STATIONS[code] for code in keys[:, i]])
+        rows = "late rows" if by == "departure" else "station rows"
+        present = (df["station rows"] > 0) | (df[rows] > 0)
+        return df[present].reset_index(drop=True)
+
+    # Cube with the months of other added (or replaced) and the months of drop
+    # taken out. The other months are kept as they are: only the monthly totals
+    # are moved, the rows of these months are not needed.
+    def replace(self, other, drop=()):
+        keep = ~np.isin(self.months, list(drop) + list(other.months))
+        months = np.union1d(self.months[keep], other.months)
+        keys = {}
+        sums = {}
+        for by, (_, measures) in GROUPINGS.items():
+            group_keys, groups = np.unique(
+                np.concatenate([self.keys[by], other.keys[by]]),
+                axis=0,
+                return_inverse=True,
+            )
+            groups = groups.reshape(-1)
+            before = len(self.keys[by])
+            totals = np.zeros((len(months), len(group_keys), len(measures)))
+            rows = np.searchsorted(months, self.months[keep])
+            totals[rows[:, None], groups[None, :before]] = np.diff(
+                self.sums[by], axis=0
+            )[keep]
+            rows = np.searchsorted(months, other.months)
+            totals[rows[:, None], groups[None, before:]] = np.diff(
+                other.sums[by], axis=0
+            )
+            cumulative = np.zeros((len(months) + 1,) + totals.shape[1:])
+            np.cumsum(totals, axis=0, out=cumulative[1:])
+            keys[by] = group_keys.astype("int16")
+            sums[by] = cumulative
+        return Cube(months, keys, sums)
+
+    def save(self, path):
+        path = Path(path)
+        arrays = {
+            "months": self.months,
+            "key": np.array(self.key or ""),
+            "partitions": np.array(json.dumps(self.partitions)),
+        }
+        for by in GROUPINGS:
+            arrays["keys_" + by] = self.keys[by]
+            arrays["sums_" + by] = self.sums[by]
+        tmp = temp_path(path)
+        with open(tmp, "wb") as out:
+            np.savez(out, **arrays)
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            keys = {by: data["keys_" + by] for by in GROUPINGS}
+            sums = {by: data["sums_" + by] for by in GROUPINGS}
+            partitions = None
+            if "partitions" in data.files:
+                partitions = json.loads(str(data["partitions"]))
+            return cls(data["months"], keys, sums, str(data["key"]), partitions)
+
+
+# Values of the measures of every row of the frame, 0 when the row doesn't count
+# for the measure.
+def _measures(csv):
+    values = {}
+    station = csv[STATION_COUNTS].notna().all(axis=1).to_numpy()
+    values["station rows"] = station.astype("float64")
+    for column in STATION_COUNTS:
+        values[column] = np.where(
+            station, csv[column].to_numpy("float64", na_value=0), 0
+        )
+
+    late = csv[LATE_COUNTS].notna().all(axis=1).to_numpy()
+    values["late rows"] = late.astype("float64")
+    for column in LATE_COUNTS:
+        values[column] = np.where(late, csv[column].to_numpy("float64", na_value=0), 0)
+    has_pct = late & csv["Total Pct"].notna().to_numpy()
+    weight = np.where(has_pct, values["Number of trains delayed at arrival"], 0)
+    values["pct rows"] = has_pct.astype("float64")
+    values["pct weight"] = weight
+    for cause in LATE_CAUSES:
+        pct = csv[cause].to_numpy("float64", na_value=0)
+        values["sum " + cause] = np.where(has_pct, pct, 0)
+        values["weighted " + cause] = np.where(has_pct, pct * weight, 0)
+    return values
+
+
+# Builds the cube of a loaded frame (with the station columns as categoricals of
+# the station list, like load_dataset returns them).
+def build_cube(csv, key=None):
+    csv = csv[csv["Date"].notna()]
+    month = csv["Date"].dt.strftime("%Y-%m").to_numpy(dtype=str)
+    months = np.unique(month)
+    month_codes = np.searchsorted(months, month)
+    values = _measures(csv)
+
+    keys = {}
+    sums = {}
+    for by, (columns, measures) in GROUPINGS.items():
+        codes = np.stack([csv[c].cat.codes.to_numpy() for c in columns], axis=1)
+        valid = (codes >= 0).all(axis=1)
+        group_keys, groups = np.unique(codes[valid], axis=0, return_inverse=True)
+        groups = groups.reshape(-1)
+        cells = month_codes[valid] * len(group_keys) + groups
+        size = len(months) * len(group_keys)
+        totals = np.stack(
+            [
+                np.bincount(cells, weights=values[m][valid], minlength=size)
+                for m in measures
+            ],
+            axis=1,
+        ).reshape(len(months), len(group_keys), len(measures))
+        cumulative = np.zeros((len(months) + 1,) + totals.shape[1:])
+        np.cumsum(totals, axis=0, out=cumulative[1:])
+        keys[by] = group_keys.astype("int16")
+        sums[by] = cumulative
+    return Cube(months, keys, sums, key)
+
+
+def empty_cube():
+    keys = {}
+    sums = {}
+    for by, (columns, measures) in GROUPINGS.items():
+        keys[by] = np.zeros((0, len(columns)), dtype="int16")
+        sums[by] = np.zeros((1, 0, len(measures)))
+    return Cube([], keys, sums)
+
+
+# Key of the cube file: the fingerprint of the data it is built from.
+def data_key(store=STORE_DIR, csv_file=CSV_FILE):
+    fingerprint = data_fingerprint(store, csv_file)
+    if fingerprint is None:
+        return None
+    return f"{CUBE_VERSION}-{fingerprint}"
+
+
+def cube_file(store=STORE_DIR, csv_file=CSV_FILE):
+    if load_manifest(store)["partitions"]:
+        return Path(store) / CUBE_FILE
+    return Path(csv_file).with_suffix(".cube.npz")
+
+
+# Returns the cube of the cleaned dataset, saved next to it.
+# It is only built again when the data changed since it was saved. With a store,
+# the saved cube is updated instead: only the months that changed are read.
+# Returns None if no dataset is available.
+def load_cube(store=STORE_DIR, csv_file=CSV_FILE):
+    key = data_key(store, csv_file)
+    if key is None:
+        return None
+    path = cube_file(store, csv_file)
+    cube = None
+    if path.exists():
+        cube = Cube.load(path)
+        if cube.key == key:
+            return cube
+    manifest = load_manifest(store)
+    if manifest["partitions"]:
+        partitions = {
+            "signature": manifest["signature"],
+            "hashes": {
+                month: info["hash"]
+                for month, info in manifest["partitions"].items()
+                if not is_undated(month)
+            },
+        }
+        cube = _update_cube(cube, store, partitions)
+        cube.key = key
+        cube.partitions = partitions
+    else:
+        csv = load_dataset(CUBE_COLUMNS, store=store, csv_file=csv_file)
+        if csv is None:
+            return None
+        cube = build_cube(csv, key)
+    cube.save(path)
+    return cube
+
+
+# Cube of the dated partitions of the store from the cube saved before (None
+# when there is none): the months that changed are read and replace theirs, the
+# months no longer in the store are taken out. Built from the whole store when
+# the saved cube is of another version or cleaning.
+def _update_cube(cube, store, partitions):
+    hashes = partitions["hashes"]
+    before = None if cube is None else cube.partitions
+    if (
+        before is None
+        or not cube.key.startswith(f"{CUBE_VERSION}-")
+        or before["signature"] != partitions["signature"]
+    ):
+        return build_cube(load_dataset(CUBE_COLUMNS, store=store))
+    changed = sorted(m for m, h in hashes.items() if before["hashes"].get(m) != h)
+    dropped = [m for m in before["hashes"] if m not in hashes]
+    if not changed:
+        return cube.replace(empty_cube(), dropped)
+    csv = compact(read_partitions(store, changed, CUBE_COLUMNS))
+    return cube.replace(build_cube(csv), dropped)
+
+
+if __name__ == "__main__":
+    cube = load_cube()
+    if cube is None:
+        print("No cleaned dataset, run incremental.py first.")
+    else:
+        print(f"Months: {len(cube.months)} ({cube.months[0]} to {cube.months[-1]})")
+        for by in GROUPINGS:
+            print(f"{by}: {cube.sums[by].shape[1]} groups")
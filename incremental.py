@@ -0,0 +1,298 @@
+import argparse
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from cleaning import (
+    COLUMN_RULES,
+    COMMENT_COLUMNS,
+    SERVICES,
+    STATIONS,
+    CanonicalCache,
+    clean,
+    clean_date,
+)
+from cube import load_cube
+from registry import DELAY_MODEL, ModelRegistry
+from storage import (
+    CSV_FILE,
+    STORE_DIR,
+    UNDATED,
+    is_undated,
+    load_manifest,
+    load_mapped,
+    partition_file,
+    save_manifest,
+    store_months,
+    temp_path,
+    undated_partition,
+    write_partition,
+)
+
+CHUNK_ROWS = 100_000
+SORT_COLUMNS = ["Date", "Service", "Departure station", "Arrival station"]
+# Bumped when the layout of the store or the month hashes change: every month
+# is cleaned again.
+STORE_VERSION = 2
+# Month hashes of every raw source, reused while the file keeps its size and
+# modification time (in the store).
+HASHES_FILE = "raw_hashes.json"
+# Where each month ends in the csv file written by export.
+EXPORT_FILE = "export.json"
+# Keys of the two row hashes summed per month (16 characters each).
+HASH_KEYS = ("tardis-raw-row-1", "tardis-raw-row-2")
+
+
+# Fingerprint of the cleaning configuration: when the rules or the station list
+# change, every month has to be cleaned again.
+def cleaning_signature():
+    rules = {
+        column: {k: (v.__name__ if isinstance(v, type) else v) for k, v in rule.items()}
+        for column, rule in COLUMN_RULES.items()
+    }
+    key = json.dumps(
+        [STORE_VERSION, rules, SERVICES, STATIONS], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+# Month of each raw row ("YYYY-MM"), rows without a valid date go in undated
+# (the undated partition of their source, see storage.undated_partition).
+def partition_of(dates, undated=UNDATED):
+    return clean_date(dates).dt.strftime("%Y-%m").fillna(undated)
+
+
+# Reads the raw sources as strings, chunk by chunk, so that the same raw row
+# always gives the same hash whatever file or chunk it comes from.
+def read_raw(sources, sep=";", chunk_rows=CHUNK_ROWS):
+    for source in sources:
+        yield from pd.read_csv(source, sep=sep, dtype=str, chunksize=chunk_rows)
+
+
+# Sums of the hashes of the rows of every month of one raw source, and their
+# number: [sum 1, sum 2, rows]. Rows are hashed without the comment columns
+# (they are dropped by the cleaning) and the hashes are added (modulo 2^64), so
+# the row order doesn't matter and the sums of several sources can be added.
+def hash_source(source, sep=";", chunk_rows=CHUNK_ROWS):
+    sums = {}
+    undated = undated_partition(source)
+    for chunk in read_raw([source], sep, chunk_rows):
+        data = chunk.drop(columns=COMMENT_COLUMNS, errors="ignore")
+        data = data[sorted(data.columns)]
+        hashes = np.stack(
+            [
+                pd.util.hash_pandas_object(data, index=False, hash_key=key).to_numpy()
+                for key in HASH_KEYS
+            ],
+            axis=1,
+        )
+        months, groups = np.unique(
+            partition_of(chunk["Date"], undated).to_numpy(dtype=str),
+            return_inverse=True,
+        )
+        totals = np.zeros((len(months), len(HASH_KEYS)), dtype="uint64")
+        np.add.at(totals, groups, hashes)
+        counts = np.bincount(groups, minlength=len(months))
+        for month, total, count in zip(months, totals.tolist(), counts.tolist()):
+            sums[month] = _add_sums(sums.get(month), total + [count])
+    return sums
+
+
+def _add_sums(before, sums):
+    if before is None:
+        return sums
+    hashes = [(a + b) % 2**64 for a, b in zip(before[:-1], sums[:-1])]
+    return hashes + [before[-1] + sums[-1]]
+
+
+# Content hash of every month of the raw data. The sums of a source are taken
+# from cache (see hash_source) while its size and modification time are the
+# same, the source is only read again when it changed; cache is updated.
+def hash_partitions(sources, sep=";", chunk_rows=CHUNK_ROWS, cache=None):
+    cache = {} if cache is None else cache
+    totals = {}
+    for source in sources:
+        path = Path(source)
+        stat = path.stat()
+        state = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sep": sep}
+        key = str(path.resolve())
+        if {k: cache.get(key, {}).get(k) for k in state} != state:
+            cache[key] = dict(state, months=hash_source(source, sep, chunk_rows))
+        for month, sums in cache[key]["months"].items():
+            totals[month] = _add_sums(totals.get(month), sums)
+    return {
+        month: {
+            "hash": hashlib.sha1(json.dumps(total).encode("utf-8")).hexdigest(),
+            "raw_rows": total[-1],
+        }
+        for month, total in totals.items()
+    }
+
+
+def load_hashes(store=STORE_DIR):
+    path = Path(store) / HASHES_FILE
+    if path.exists():
+        hashes = json.loads(path.read_text(encoding="utf-8"))
+        if hashes.get("version") == STORE_VERSION:
+            return hashes
+    return {"version": STORE_VERSION, "sources": {}}
+
+
+def save_hashes(store, hashes):
+    path = Path(store) / HASHES_FILE
+    tmp = temp_path(path)
+    tmp.write_text(json.dumps(hashes, indent=1, sort_keys=True), encoding="utf-8")
+    tmp.replace(path)
+
+
+# Cleans the raw rows of the given months at once and replaces their files,
+# the rows without a date go in the undated partition.
+# Returns the number of cleaned rows of each month.
+def write_partitions(store, raw, cache, undated=UNDATED):
+    csv, _ = clean(raw, cache)
+    csv = csv.drop_duplicates()
+    csv = csv.sort_values(SORT_COLUMNS)
+    rows = {}
+    months = csv["Date"].dt.strftime("%Y-%m").fillna(undated)
+    for month, part in csv.groupby(months, sort=False):
+        write_partition(store, month, part)
+        rows[month] = len(part)
+    return rows
+
+
+# Updates the cleaned store (see storage.py) with the months of the sources that
+# are new or whose content changed since the last run. The other months are not
+# read again nor rewritten, and the sources that didn't change since the last
+# run are not even read. Months missing from the sources are kept as they are.
+# The rows without a date are kept per source: a source only replaces its own.
+def update(sources, store=STORE_DIR, sep=";", full=False, cache=None):
+    Path(store).mkdir(parents=True, exist_ok=True)
+    cache = cache if cache is not None else CanonicalCache()
+    manifest = load_manifest(store)
+    signature = cleaning_signature()
+    if manifest["signature"] != signature:
+        full = True
+
+    hashes = load_hashes(store)
+    partitions = hash_partitions(sources, sep, cache=hashes["sources"])
+    save_hashes(store, hashes)
+    known = manifest["partitions"]
+    dirty = {
+        month
+        for month, info in partitions.items()
+        if full
+        or month not in known
+        or known[month]["hash"] != info["hash"]
+        or not partition_file(store, month).exists()
+    }
+
+    if dirty:
+        # only the sources with rows in a dirty month are read again; their dated
+        # rows are cleaned at once, their undated rows per source
+        read = [
+            source
+            for source in sources
+            if dirty & set(hashes["sources"][str(Path(source).resolve())]["months"])
+        ]
+        batches = {UNDATED: []}
+        for source in read:
+            undated = undated_partition(source)
+            for chunk in read_raw([source], sep):
+                months = partition_of(chunk["Date"], undated)
+                rows = months.isin(dirty)
+                dated = months != undated
+                batches[UNDATED].append(chunk[rows & dated])
+                if (rows & ~dated).any():
+                    batches.setdefault(undated, []).append(chunk[rows & ~dated])
+        rows = {}
+        for undated, chunks in batches.items():
+            raw = pd.concat(chunks, ignore_index=True)
+            if len(raw):
+                rows.update(write_partitions(store, raw, cache, undated))
+        for month in dirty:
+            known[month] = dict(partitions[month], rows=rows.get(month, 0))
+        cache.save()
+    # undated partition of a store written before they were kept per source
+    if full and UNDATED in known and UNDATED not in partitions:
+        partition_file(store, UNDATED).unlink(missing_ok=True)
+        del known[UNDATED]
+
+    manifest["signature"] = signature
+    save_manifest(store, manifest)
+    return sorted(dirty)
+
+
+# Writes the whole cleaned dataset in one csv file, month after month. The month
+# files are already sorted, so they only have to be appended in order.
+# Where each month ends in the file is kept (cleaned/export.json): while the file
+# is the one written last time, it is cut after the last month that didn't
+# change and only the months from there are written again (for a new month, its
+# rows and the rows without a date, which come last).
+def export(store=STORE_DIR, output=CSV_FILE):
+    manifest = load_manifest(store)
+    months = [
+        [month, manifest["partitions"][month]["hash"]] for month in store_months(store)
+    ]
+    index_path = Path(store) / EXPORT_FILE
+    index = {}
+    if index_path.exists():
+        index = json.loads(index_path.read_text(encoding="utf-8"))
+    path = Path(output)
+    written = []
+    if (
+        path.exists()
+        and index.get("output") == str(path.resolve())
+        and index.get("signature") == manifest["signature"]
+        and index.get("size") == path.stat().st_size
+        and index.get("mtime_ns") == path.stat().st_mtime_ns
+    ):
+        for entry, month in zip(index["months"], months):
+            if entry[:2] != month:
+                break
+            written.append(entry)
+    with open(path, "r+b" if written else "wb") as out:
+        out.truncate(written[-1][2] if written else 0)
+        out.seek(0, 2)
+        for month, partition_hash in months[len(written) :]:
+            part = pq.ParquetFile(partition_file(store, month)).read().to_pandas()
+            out.write(part.to_csv(index=False, header=not written).encode("utf-8"))
+            written.append([month, partition_hash, out.tell()])
+    stat = path.stat()
+    index = {
+        "output": str(path.resolve()),
+        "signature": manifest["signature"],
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "months": written,
+    }
+    tmp = temp_path(index_path)
+    tmp.write_text(json.dumps(index, indent=1), encoding="utf-8")
+    tmp.replace(index_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Clean only the new or changed months of the raw data."
+    )
+    parser.add_argument("sources", nargs="*", default=["assets/dataset.csv"])
+    parser.add_argument("--store", default=STORE_DIR)
+    parser.add_argument("--output", default=CSV_FILE)
+    parser.add_argument("--full", action="store_true", help="clean every month again")
+    args = parser.parse_args()
+
+    cleaned = update(args.sources, args.store, full=args.full)
+    # the csv file and what is built from the store are only written again when
+    # a month changed
+    if cleaned or not Path(args.output).exists():
+        export(args.store, args.output)
+        load_cube(args.store, args.output)
+        load_mapped(store=args.store, csv_file=args.output)
+        registry = ModelRegistry(store=args.store, csv_file=args.output)
+        registry.get(*DELAY_MODEL)
+        # sums of the same routes on every row: only the cleaned months are read
+        registry.online(*DELAY_MODEL[:2])
+    print(f"Cleaned months: {len(cleaned)}", *(f"\n  {month}" for month in cleaned))
@@ -6,7 +6,7 @@ sudo apt install jupyter
 jupyter nbconvert --to script tardis_eda.ipynb
 jupyter nbconvert --to script tardis_model.ipynb
 
-python3 tardis_eda.py
+python3 incremental.py assets/dataset.csv
 
 mv tardis_model.py dataset.py
 
@@ -0,0 +1,203 @@
+import argparse
+import json
+import random
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+APP_FILE = "tardis_dashboard.py"
+SESSIONS = 4
+# Rounds of the scenario played by each session (see Session.scenario).
+ROUNDS = 3
+TIMEOUT = 120
+PERCENTILES = [50, 95, 99]
+
+# AppTest installs a process-wide runtime for each run, so the runs of two sessions
+# can't overlap: the sessions interleave their reruns, like the script threads of
+# one server on one core. The time a rerun waits for the others is reported apart.
+RUN_LOCK = threading.Lock()
+
+
+# Resident memory of the process (MB), from /proc on Linux, the peak elsewhere.
+def rss_mb():
+    statm = Path("/proc/self/statm")
+    if statm.exists():
+        pages = int(statm.read_text().split()[1])
+        return pages * resource.getpagesize() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+# One user of the dashboard, driven headlessly with AppTest: every interaction is
+# a rerun of the whole script, timed from the change of the widget to the end of
+# the rerun. The caches of the script (st.cache_data, st.cache_resource) are the
+# ones of the process, shared by every session like on the server.
+class Session:
+    def __init__(self, number, seed=0, app_file=APP_FILE):
+        self.number = number
+        self.rng = random.Random(seed * 10_000 + number)
+        self.at = AppTest.from_file(app_file, default_timeout=TIMEOUT)
+        self.timings = []
+
+    def rerun(self, page, action, change=None):
+        queued = time.perf_counter()
+        with RUN_LOCK:
+            start = time.perf_counter()
+            if change is None:
+                self.at.run()
+            else:
+                change().run()
+            seconds = time.perf_counter() - start
+        errors = [str(e.value) for e in self.at.exception]
+        self.timings.append(
+            {
+                "session": self.number,
+                "page": page,
+                "action": action,
+                "seconds": seconds,
+                "waited": start - queued,
+                "errors": len(errors),
+            }
+        )
+        if errors:
+            raise RuntimeError(f"{page} {action}: {errors[0]}")
+
+    # Same page changes as the buttons of the home page.
+    def open(self, page):
+        self.at.session_state.page = page
+        self.rerun(page, "open")
+
+    def home(self):
+        self.open("home")
+
+    def data(self):
+        self.open("data")
+        slider = self.at.main.select_slider[0]
+        months = list(slider.options)
+        start, end = sorted(self.rng.sample(range(len(months)), 2))
+        self.rerun(
+            "data", "dates", lambda: slider.set_range(months[start], months[end])
+        )
+        stations = self.at.main.multiselect[0]
+        picked = self.rng.sample(list(stations.options), self.rng.randint(1, 4))
+        self.rerun("data", "stations", lambda: stations.set_value(picked))
+        causes = self.at.main.selectbox[0]
+        station = self.rng.choice(list(causes.options))
+        self.rerun("data", "cause station", lambda: causes.set_value(station))
+
+    def pred(self):
+        self.open("pred")
+        departure = self.at.main.selectbox[0]
+        station = self.rng.choice(list(departure.options))
+        self.rerun("pred", "departure", lambda: departure.set_value(station))
+        arrival = self.at.main.selectbox[1]
+        if arrival.options:
+            station = self.rng.choice(list(arrival.options))
+            self.rerun("pred", "arrival", lambda: arrival.set_value(station))
+
+    def planner(self):
+        self.open("planner")
+        city = self.at.selectbox(key="selected_city")
+        name = self.rng.choice(list(city.options))
+        self.rerun("planner", "city", lambda: city.set_value(name))
+        tickets = self.at.number_input(key="ticket_metro")
+        count = self.rng.randint(0, 10)
+        self.rerun("planner", "tickets", lambda: tickets.set_value(count))
+
+    def language(self):
+        selector = self.at.sidebar.selectbox[0]
+        lang = self.rng.choice(list(selector.options))
+        self.rerun(
+            self.at.session_state.page, "language", lambda: selector.set_value(lang)
+        )
+
+    # First run, then each round goes through every page in a random order and
+    # changes the language once.
+    def scenario(self, rounds=ROUNDS):
+        self.rerun("home", "start")
+        for _ in range(rounds):
+            pages = [self.home, self.data, self.pred, self.planner]
+            self.rng.shuffle(pages)
+            for page in pages:
+                page()
+            self.language()
+        return self.timings
+
+
+# Plays the scenario in concurrent sessions. Returns the timings of every rerun
+# and the memory used: the growth of the resident memory of the process divided
+# by the number of sessions (the sessions are kept until the end).
+def run(sessions=SESSIONS, rounds=ROUNDS, seed=0, app_file=APP_FILE):
+    before = rss_mb()
+    players = [Session(number, seed, app_file) for number in range(sessions)]
+    barrier = threading.Barrier(sessions)
+
+    def play(session):
+        barrier.wait()
+        return session.scenario(rounds)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(sessions) as pool:
+        timings = [row for rows in pool.map(play, players) for row in rows]
+    elapsed = time.perf_counter() - start
+    memory = {
+        "rss before MB": before,
+        "rss after MB": rss_mb(),
+        "per session MB": (rss_mb() - before) / sessions,
+        "elapsed s": elapsed,
+    }
+    return pd.DataFrame(timings), memory
+
+
+# Percentiles of the rerun latency (ms), for all the reruns and by page and action,
+# and of the latency seen by the user (waiting for the other sessions included).
+def summary(timings, percentiles=PERCENTILES):
+    def stats(seconds):
+        ms = seconds.to_numpy() * 1000
+        row = {f"p{p}": np.percentile(ms, p) for p in percentiles}
+        return pd.Series(dict(row, max=ms.max(), reruns=len(ms)))
+
+    seen = timings["seconds"] + timings["waited"]
+    overall = pd.DataFrame(
+        {"all": stats(timings["seconds"]), "all, waiting included": stats(seen)}
+    ).T
+    by_action = timings.groupby(["page", "action"])["seconds"].apply(stats).unstack()
+    by_action.index = [" ".join(index) for index in by_action.index]
+    return pd.concat([overall, by_action])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rerun latency of the dashboard under concurrent sessions."
+    )
+    parser.add_argument("--sessions", type=int, default=SESSIONS)
+    parser.add_argument("--rounds", type=int, default=ROUNDS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--app", default=APP_FILE)
+    parser.add_argument("--output", help="write the timings and summary (JSON)")
+    args = parser.parse_args()
+
+    timings, memory = run(args.sessions, args.rounds, args.seed, args.app)
+    table = summary(timings)
+    print(table.to_string(float_format="{:.1f}".format))
+    print(
+        f"{args.sessions} sessions, {len(timings)} reruns in "
+        f"{memory['elapsed s']:.1f} s, "
+        f"memory {memory['rss before MB']:.0f} -> {memory['rss after MB']:.0f} MB "
+        f"({memory['per session MB']:.1f} MB per session)"
+    )
+    if args.output:
+        report = {
+            "sessions": args.sessions,
+            "rounds": args.rounds,
+            "seed": args.seed,
+            "memory": memory,
+            "summary": table.reset_index(names="reruns of").to_dict("records"),
+            "timings": timings.to_dict("records"),
+        }
+        Path(args.output).write_text(json.dumps(report, indent=1), encoding="utf-8")
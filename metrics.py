@@ -0,0 +1,198 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Set per deployment:
+# - TARDIS_METRICS_PORT: serves the metrics in the Prometheus text format
+# - TARDIS_METRICS_FILE: writes one JSON line per rerun, in rotating files
+# - TARDIS_DEBUG_PANEL: shows the breakdown of the rerun in the sidebar
+METRICS_PORT = os.environ.get("TARDIS_METRICS_PORT")
+METRICS_FILE = os.environ.get("TARDIS_METRICS_FILE")
+DEBUG_PANEL = os.environ.get("TARDIS_DEBUG_PANEL", "") not in ("", "0")
+LOG_BYTES = 10 * 2**20
+LOG_BACKUPS = 5
+
+# Upper bounds (seconds) of the buckets of the span histograms.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Rerun (or request) the spans and counters of the current thread belong to.
+_current = contextvars.ContextVar("rerun", default=None)
+
+
+# Spans and counters of one rerun of the dashboard, with its page and inputs.
+class Rerun:
+    def __init__(self, page, tags):
+        self.page = page
+        self.tags = tags
+        self.time = time.time()
+        self.seconds = None
+        self.spans = []
+        self.counters = defaultdict(float)
+
+    def as_dict(self):
+        return {
+            "time": self.time,
+            "page": self.page,
+            "tags": self.tags,
+            "seconds": self.seconds,
+            "spans": self.spans,
+            "counters": dict(self.counters),
+        }
+
+
+# Totals of the process since it started: a histogram of the duration of each
+# span by page, and the counters. Updating them only takes a lock and a few
+# additions, so they can be left on.
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = defaultdict(float)
+        self.log = None
+
+    def observe(self, name, page, seconds):
+        with self.lock:
+            histogram = self.histograms.get((name, page))
+            if histogram is None:
+                histogram = self.histograms[(name, page)] = {
+                    "buckets": [0] * len(BUCKETS),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def add(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def prometheus(self):
+        lines = ["# TYPE tardis_span_seconds histogram"]
+        with self.lock:
+            for (name, page), histogram in sorted(self.histograms.items()):
+                labels = f'span="{_escape(name)}",page="{_escape(page)}"'
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    lines.append(
+                        f'tardis_span_seconds_bucket{{{labels},le="{bound}"}} {count}'
+                    )
+                lines.append(
+                    f'tardis_span_seconds_bucket{{{labels},le="+Inf"}} '
+                    f'{histogram["count"]}'
+                )
+                lines.append(f"tardis_span_seconds_sum{{{labels}}} {histogram['sum']}")
+                lines.append(
+                    f"tardis_span_seconds_count{{{labels}}} {histogram['count']}"
+                )
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f"# TYPE tardis_{name}_total counter")
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                        lines.append(f"tardis_{name}_total{{{text}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    # One JSON line per rerun, in files of max_bytes (backups old files kept).
+    def open_log(self, path, max_bytes=LOG_BYTES, backups=LOG_BACKUPS):
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.log = logging.getLogger("tardis.metrics")
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.log.addHandler(handler)
+
+    def write(self, rerun):
+        if self.log is not None:
+            self.log.info(json.dumps(rerun.as_dict(), default=str))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = Registry()
+
+
+# Times the block: added to the histogram of its name (and of the page of the
+# current rerun) and to the breakdown of the current rerun, with its tags
+# (inputs of the block, only kept in the breakdown).
+@contextmanager
+def span(name, **tags):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        rerun = _current.get()
+        METRICS.observe(name, rerun.page if rerun else "", seconds)
+        if rerun is not None:
+            rerun.spans.append({"name": name, "seconds": seconds, "tags": tags})
+
+
+def count(name, value=1, **labels):
+    METRICS.add(name, labels, value)
+    rerun = _current.get()
+    if rerun is not None:
+        key = " ".join([name] + [str(v) for v in labels.values()])
+        rerun.counters[key] += value
+
+
+# Collects the spans and counters of one rerun of a page. At the end its total is
+# added to the "rerun" histogram and it is written in the JSON lines file.
+@contextmanager
+def rerun(page, **tags):
+    record = Rerun(page, tags)
+    token = _current.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        _current.reset(token)
+        METRICS.observe("rerun", page, record.seconds)
+        METRICS.write(record)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Starts what the environment asks for: the Prometheus endpoint (in a thread of
+# the process) and the JSON lines file. Called once per process: when several
+# processes share the port, the first one serves it and the others log why they
+# don't and go on without it.
+def start(port=METRICS_PORT, path=METRICS_FILE):
+    if path:
+        METRICS.open_log(path)
+    if port:
+        try:
+            server = ThreadingHTTPServer(("", int(port)), _MetricsHandler)
+        except OSError as error:
+            logging.getLogger("tardis.metrics").warning(
+                "metrics endpoint not started on port %s: %s", port, error
+            )
+            return None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    return None
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import threading
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from regression import (
+    CV_FOLDS,
+    CV_START,
+    CV_STEP,
+    DEGREES,
+    TRAIN_SHARE,
+    OnlineModels,
+    fit_routes,
+    select_degrees,
+)
+from storage import (
+    CSV_FILE,
+    STATION_DTYPE,
+    STORE_DIR,
+    UNDATED,
+    data_fingerprint,
+    is_undated,
+    load_dataset,
+    load_manifest,
+    read_partitions,
+    temp_path,
+)
+
+MODELS_DIR = "models"
+# Bumped when the saved content changes, so that old files are fitted again.
+REGISTRY_VERSION = 2
+
+# Degree of the models chosen route by route (see regression.select_degrees).
+AUTO_DEGREE = "auto"
+
+# Model of the prediction page: delayed trains at departure from scheduled trains.
+DELAY_MODEL = (
+    "Number of scheduled trains",
+    "Number of trains delayed at departure",
+    AUTO_DEGREE,
+)
+
+
+# Fitted models of every route for one set of parameters. The arrays come from a
+# registry file, memory-mapped: only the pages that are used are read.
+class RouteModels:
+    def __init__(self, arrays, params):
+        self.arrays = arrays
+        self.params = params
+        self._routes = None
+
+    def __len__(self):
+        return len(self.arrays["n"])
+
+    # Position of each (departure, arrival) pair, built on first use.
+    @property
+    def routes(self):
+        if self._routes is None:
+            stations = STATION_DTYPE.categories
+            self._routes = {
+                (stations[dep], stations[arr]): i
+                for i, (dep, arr) in enumerate(self.arrays["codes"].tolist())
+            }
+        return self._routes
+
+    # Degree, coefficients (highest power first), R², RMSE and number of rows of
+    # a route, None if the route has no model.
+    def get(self, departure, arrival):
+        i = self.routes.get((departure, arrival))
+        if i is None or self.arrays["n_train"][i] == 0:
+            return None
+        degree = int(self.arrays["degree"][i])
+        return {
+            "degree": degree,
+            "coeffs": np.array(self.arrays["coeffs"][i][-(degree + 1) :]),
+            "r2": float(self.arrays["r2"][i]),
+            "rmse": float(self.arrays["rmse"][i]),
+            "n": int(self.arrays["n"][i]),
+        }
+
+    # Degree of the model of a route (default when it has none).
+    def degree(self, departure, arrival, default=3):
+        i = self.routes.get((departure, arrival))
+        return default if i is None else int(self.arrays["degree"][i])
+
+
+# Fitted route models saved on disk, one file per set of parameters and version
+# of the cleaned data (models/<parameters>_<data>.joblib).
+# Files are only opened when a model is asked for, and the models are fitted and
+# saved only when no file matches: a restarted dashboard doesn't fit anything.
+# A registry is shared by the dashboard sessions and the API worker threads: the
+# models of a version are fitted by one of them, the others wait for them.
+class ModelRegistry:
+    def __init__(self, directory=MODELS_DIR, store=STORE_DIR, csv_file=CSV_FILE):
+        self.directory = Path(directory)
+        self.store = store
+        self.csv_file = csv_file
+        self.loaded = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def params_key(type1, type2, degree):
+        params = [REGISTRY_VERSION, type1, type2, degree, TRAIN_SHARE]
+        if degree == AUTO_DEGREE:
+            params += [DEGREES, CV_START, CV_STEP, CV_FOLDS]
+        key = json.dumps(params)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    def path(self, type1, type2, degree):
+        fingerprint = data_fingerprint(self.store, self.csv_file)
+        if fingerprint is None:
+            return None
+        name = f"{self.params_key(type1, type2, degree)}_{fingerprint[:16]}.joblib"
+        return self.directory / name
+
+    # Models of every route for the parameters (None without data). With
+    # AUTO_DEGREE, each route has the degree chosen by cross validation.
+    # csv is only used when they have to be fitted, the dataset is loaded otherwise.
+    def get(self, type1, type2, degree=3, csv=None):
+        path = self.path(type1, type2, degree)
+        if path is None:
+            return None
+        with self.lock:
+            if path not in self.loaded:
+                if not path.exists():
+                    self.save(path, type1, type2, degree, csv)
+                arrays = joblib.load(path, mmap_mode="r")
+                prefix = path.name.split("_")[0]
+                self.loaded = {
+                    other: models
+                    for other, models in self.loaded.items()
+                    if not other.name.startswith(prefix)
+                }
+                self.loaded[path] = RouteModels(arrays, (type1, type2, degree))
+            return self.loaded[path]
+
+    def save(self, path, type1, type2, degree, csv=None):
+        if csv is None:
+            columns = ["Departure station", "Arrival station", type1, type2]
+            csv = load_dataset(columns, store=self.store, csv_file=self.csv_file)
+        route = ["Departure station", "Arrival station"]
+        chosen = None
+        degrees = [degree]
+        if degree == AUTO_DEGREE:
+            chosen = select_degrees(csv, type1, type2).set_index(route)["degree"]
+            degrees = sorted(chosen.unique())
+        # one fit of every route per degree, each route keeps the one of its degree
+        parts = []
+        for fitted in degrees:
+            part = fit_routes(csv, type1, type2, fitted).set_index(route)
+            if chosen is not None:
+                part = part[chosen.loc[part.index].to_numpy() == fitted]
+            part["degree"] = fitted
+            parts.append(part)
+        width = max(degrees) + 1
+        table = pd.concat(parts).reset_index()
+        table = table.fillna({f"x^{power}": 0.0 for power in range(width)})
+        stations = STATION_DTYPE.categories
+        arrays = {
+            "codes": np.stack(
+                [
+                    stations.get_indexer(table["Departure station"]),
+                    stations.get_indexer(table["Arrival station"]),
+                ],
+                axis=1,
+            ),
+            "coeffs": table[[f"x^{p}" for p in range(width - 1, -1, -1)]].to_numpy(),
+            "degree": table["degree"].to_numpy(dtype="int64"),
+            "n": table["n"].to_numpy(),
+            "n_train": table["n_train"].to_numpy(),
+            "r2": table["r2"].to_numpy(),
+            "rmse": table["rmse"].to_numpy(),
+        }
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = temp_path(path)
+        joblib.dump(arrays, tmp)
+        tmp.replace(path)
+        # files of the same parameters fitted on an older version of the data
+        prefix = path.name.split("_")[0]
+        for old in self.directory.glob(prefix + "_*.joblib"):
+            if old != path:
+                old.unlink()
+
+    # Route models of every row of the store kept as sums (see
+    # regression.OnlineModels), saved in models/online_<parameters>_<cleaning>.joblib
+    # with the hash of each partition they were summed from. Each call only reads
+    # the partitions that changed since the last one and takes out the months that
+    # are no longer in the store. None without a store.
+    def online(self, type1, type2, degree=3):
+        manifest = load_manifest(self.store)
+        partitions = {
+            month: info["hash"] for month, info in manifest["partitions"].items()
+        }
+        if not partitions:
+            return None
+        params = json.dumps([REGISTRY_VERSION, "online", type1, type2, degree])
+        prefix = "online_" + hashlib.sha1(params.encode("utf-8")).hexdigest()[:16]
+        signature = json.dumps(manifest["signature"]).encode("utf-8")
+        path = (
+            self.directory
+            / f"{prefix}_{hashlib.sha1(signature).hexdigest()[:16]}.joblib"
+        )
+        with self.lock:
+            models, hashes = OnlineModels(type1, type2, degree), {}
+            if path.exists():
+                models, hashes = joblib.load(path)
+            # rows without a date are never removed: start again without them
+            if any(is_undated(m) and m not in partitions for m in hashes):
+                models, hashes = OnlineModels(type1, type2, degree), {}
+            removed = [month for month in hashes if month not in partitions]
+            for month in removed:
+                models.remove(month)
+                del hashes[month]
+            changed = sorted(m for m, h in partitions.items() if hashes.get(m) != h)
+            columns = ["Date", "Departure station", "Arrival station", type1, type2]
+            for month in changed:
+                if not is_undated(month):
+                    models.remove(month)
+                rows = read_partitions(self.store, [month], columns)
+                models.add(rows, month if is_undated(month) else UNDATED)
+                hashes[month] = partitions[month]
+            if removed or changed or not path.exists():
+                self.directory.mkdir(parents=True, exist_ok=True)
+                tmp = temp_path(path)
+                joblib.dump((models, hashes), tmp)
+                tmp.replace(path)
+                for old in self.directory.glob(prefix + "_*.joblib"):
+                    if old != path:
+                        old.unlink()
+            return models
+
+
+if __name__ == "__main__":
+    models = ModelRegistry().get(*DELAY_MODEL)
+    if models is None:
+        print("No cleaned dataset, run incremental.py first.")
+    else:
+        print(f"Route models: {len(models)}")
@@ -0,0 +1,400 @@
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from routes import station_codes
+from storage import STATION_DTYPE, UNDATED, is_undated
+
+# Share of the rows of a route used for training, the others are the test set
+# (same split as Predict.fit).
+TRAIN_SHARE = 0.8
+
+# Degrees compared by select_degrees, degree 1 is used for the routes that are
+# too short to compare them.
+DEGREES = (1, 2, 3, 4)
+LINEAR = 1
+# Rolling origin cross validation: fold k trains on the first
+# CV_START + k * CV_STEP of the rows of a route and tests on the next CV_STEP.
+CV_START = 0.6
+CV_STEP = 0.1
+CV_FOLDS = 4
+
+# Number of resamples of the bootstrap prediction intervals.
+BOOTSTRAP_DRAWS = 2000
+
+# Relative rounding error of the sums of squares computed from the sums of
+# OnlineModels (relative to the sum of y²).
+ONLINE_ROUNDING = 1e-12
+
+
+# Rows of every departure/arrival pair with both columns set, in the order of
+# the frame, as padded arrays of shape (pairs, longest route):
+# x and y are 0 after the last row of a pair and n is its number of rows.
+def route_arrays(csv, type1, type2):
+    x = csv[type1].to_numpy(dtype="float64", na_value=np.nan)
+    y = csv[type2].to_numpy(dtype="float64", na_value=np.nan)
+    departure = station_codes(csv["Departure station"])
+    arrival = station_codes(csv["Arrival station"])
+    valid = (departure >= 0) & (arrival >= 0) & ~np.isnan(x) & ~np.isnan(y)
+
+    pair = departure * len(STATION_DTYPE.categories) + arrival
+    rows = np.flatnonzero(valid)
+    rows = rows[np.argsort(pair[rows], kind="stable")]
+    pairs, starts, n = np.unique(pair[rows], return_index=True, return_counts=True)
+    group = np.repeat(np.arange(len(pairs)), n)
+    rank = np.arange(len(rows)) - np.repeat(starts, n)
+
+    padded_x = np.zeros((len(pairs), n.max(initial=0)))
+    padded_y = np.zeros_like(padded_x)
+    padded_x[group, rank] = x[rows]
+    padded_y[group, rank] = y[rows]
+    codes = np.stack(np.divmod(pairs, len(STATION_DTYPE.categories)), axis=1)
+    return codes, padded_x, padded_y, n
+
+
+# Powers 0 to degree of every value of x (stacked Vandermonde matrices),
+# computed once and shared by the fits of every degree up to this one.
+def vandermonde(x, degree):
+    return x[..., None] ** np.arange(degree + 1)
+
+
+# Least squares polynomial fit of many series at once, like np.polyfit on each
+# of them: mask tells which values of a row are used. The Vandermonde matrices
+# (basis, built from x when not given) are stacked, their columns scaled and
+# solved with one batched SVD, singular values under len(x) * eps of the largest
+# one are dropped like lstsq does.
+# Returns the coefficients, highest power first (nan for an empty series).
+def batch_polyfit(x, y, mask, degree, basis=None):
+    if basis is None:
+        basis = vandermonde(x, degree)
+    lhs = np.where(mask[..., None], basis[..., degree::-1], 0.0)
+    rhs = np.where(mask, y, 0.0)
+    scale = np.sqrt((lhs * lhs).sum(axis=1))
+    scale[scale == 0] = 1.0
+    lhs = lhs / scale[:, None, :]
+
+    u, s, vt = np.linalg.svd(lhs, full_matrices=False)
+    n = mask.sum(axis=1)
+    rcond = n * np.finfo(x.dtype).eps
+    cutoff = rcond[:, None] * s[:, :1]
+    s_inv = np.divide(1.0, s, out=np.zeros_like(s), where=s > cutoff)
+    uty = np.einsum("gnk,gn->gk", u, rhs)
+    coeffs = np.einsum("gkj,gk->gj", vt, s_inv * uty) / scale
+    coeffs[n == 0] = np.nan
+    return coeffs
+
+
+# Values of many polynomials (one per row of coeffs) at the x of the same row.
+def batch_polyval(coeffs, x):
+    values = np.zeros_like(x)
+    for power in range(coeffs.shape[1]):
+        values = values * x + coeffs[:, power, None]
+    return values
+
+
+# R² and RMSE of every row over the masked values, like sklearn's r2_score and
+# mean_squared_error: R² is nan under 2 values, 1 or 0 for a constant target.
+def batch_scores(y, predicted, mask):
+    n = mask.sum(axis=1)
+    residual = np.where(mask, (y - predicted) ** 2, 0.0).sum(axis=1)
+    mean = np.where(mask, y, 0.0).sum(axis=1) / np.maximum(n, 1)
+    total = np.where(mask, (y - mean[:, None]) ** 2, 0.0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r2 = np.where(total > 0, 1 - residual / total, (residual == 0) * 1.0)
+        rmse = np.sqrt(residual / n)
+    r2[n < 2] = np.nan
+    rmse[n == 0] = np.nan
+    return r2, rmse
+
+
+# Fits the polynomial regression of type2 on type1 of every departure/arrival
+# pair at once. Each route is split and scored like Predict.fit (first 80% of
+# its rows to train, the rest to test).
+# Returns one row per route with its number of rows, the coefficients
+# ("x^3" ... "x^0" for degree 3), R², RMSE, the mean of type1 and the model at
+# this mean (the prediction shown by the dashboard), sorted by prediction.
+def fit_routes(csv, type1, type2, degree=3):
+    codes, x, y, n = route_arrays(csv, type1, type2)
+    n_train = (n * TRAIN_SHARE).astype("int64")
+    rank = np.arange(x.shape[1])
+    rows = rank < n[:, None]
+    train = rank < n_train[:, None]
+    test = rows & ~train
+
+    coeffs = batch_polyfit(x, y, train, degree)
+    r2, rmse = batch_scores(y, batch_polyval(coeffs, x), test)
+    mean_x = x.sum(axis=1) / np.maximum(n, 1)
+
+    stations = STATION_DTYPE.categories
+    table = pd.DataFrame(
+        {
+            "Departure station": stations[codes[:, 0]],
+            "Arrival station": stations[codes[:, 1]],
+            "n": n,
+            "n_train": n_train,
+        }
+    )
+    for power, column in zip(range(degree, -1, -1), coeffs.T):
+        table[f"x^{power}"] = column
+    table["r2"] = r2
+    table["rmse"] = rmse
+    table["mean_x"] = mean_x
+    table["prediction"] = batch_polyval(coeffs, mean_x[:, None])[:, 0]
+    return table.sort_values("prediction", ascending=False, ignore_index=True)
+
+
+# Train / test masks of the folds of the rolling origin cross validation, for
+# routes of n rows. A fold is only used when its training rows can fit every
+# degree compared.
+def cv_folds(n, width, max_degree):
+    rank = np.arange(width)
+    folds = []
+    for k in range(CV_FOLDS):
+        origin = np.floor(n * (CV_START + k * CV_STEP)).astype("int64")
+        end = np.floor(n * (CV_START + (k + 1) * CV_STEP)).astype("int64")
+        if k == CV_FOLDS - 1:
+            end = n
+        usable = (origin > max_degree) & (end > origin)
+        train = (rank < origin[:, None]) & usable[:, None]
+        test = (rank >= origin[:, None]) & (rank < end[:, None]) & usable[:, None]
+        folds.append((train, test))
+    return folds
+
+
+# Squared errors and number of test values of one degree over every fold.
+def _cv_errors(x, y, basis, folds, degree):
+    errors = np.zeros(len(x))
+    count = np.zeros(len(x), dtype="int64")
+    for train, test in folds:
+        coeffs = batch_polyfit(x, y, train, degree, basis)
+        residual = np.where(test, (y - batch_polyval(coeffs, x)) ** 2, 0.0)
+        errors += np.nan_to_num(residual.sum(axis=1))
+        count += test.sum(axis=1)
+    return errors, count
+
+
+# Chooses the degree of the model of every route by rolling origin cross
+# validation (see cv_folds): the degree with the lowest RMSE over the test rows
+# of every fold, LINEAR when the route is too short to have a fold.
+# The degrees are evaluated in parallel (n_jobs as for joblib) on the same
+# Vandermonde matrices, every route at once for each of them.
+# Returns one row per route with the cross validation RMSE of each degree
+# ("cv 1", "cv 2" ...) and the chosen "degree".
+def select_degrees(csv, type1, type2, degrees=DEGREES, n_jobs=-1):
+    codes, x, y, n = route_arrays(csv, type1, type2)
+    basis = vandermonde(x, max(degrees))
+    folds = cv_folds(n, x.shape[1], max(degrees))
+    results = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_cv_errors)(x, y, basis, folds, degree) for degree in degrees
+    )
+
+    stations = STATION_DTYPE.categories
+    table = pd.DataFrame(
+        {
+            "Departure station": stations[codes[:, 0]],
+            "Arrival station": stations[codes[:, 1]],
+            "n": n,
+        }
+    )
+    scores = np.full((len(n), len(degrees)), np.inf)
+    for i, (degree, (errors, count)) in enumerate(zip(degrees, results)):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rmse = np.sqrt(errors / count)
+        scores[count > 0, i] = rmse[count > 0]
+        table[f"cv {degree}"] = np.where(count > 0, rmse, np.nan)
+    best = np.asarray(degrees)[np.argmin(scores, axis=1)]
+    table["degree"] = np.where(np.isfinite(scores).any(axis=1), best, LINEAR)
+    return table
+
+
+# Residual bootstrap of a polynomial fit: draws sets of residuals resampled
+# with replacement (centered and rescaled for the fitted degrees of freedom),
+# adds them to the fitted values and fits every resample again. The design
+# matrix is the same for all of them, so the fits are one product with its
+# pseudo-inverse (computed like polyfit: scaled columns, same cutoff).
+# Returns the coefficients of every resample (highest power first) and one more
+# residual per resample, the noise of a new observation.
+def bootstrap(x, y, degree, coeffs, draws=BOOTSTRAP_DRAWS, seed=0):
+    x = np.asarray(x, dtype="float64")
+    fitted = np.polyval(coeffs, x)
+    residuals = y - fitted
+    free = len(x) - (degree + 1)
+    if free > 0:
+        residuals = (residuals - residuals.mean()) * np.sqrt(len(x) / free)
+
+    lhs = vandermonde(x, degree)[:, ::-1]
+    scale = np.sqrt((lhs * lhs).sum(axis=0))
+    scale[scale == 0] = 1.0
+    inverse = np.linalg.pinv(lhs / scale, rcond=len(x) * np.finfo(float).eps)
+    inverse /= scale[:, None]
+
+    rng = np.random.default_rng(seed)
+    samples = fitted + residuals[rng.integers(0, len(x), size=(draws, len(x)))]
+    noise = residuals[rng.integers(0, len(x), size=draws)]
+    return samples @ inverse.T, noise
+
+
+# Prediction interval at x (a value or an array) from the bootstrap of a fit:
+# the central level share of the predictions of every resample plus its noise.
+# Returns the lower and upper bounds.
+def bootstrap_interval(coeffs, noise, x, level=0.95):
+    x = np.atleast_1d(np.asarray(x, dtype="float64"))
+    values = batch_polyval(coeffs, np.broadcast_to(x, (len(coeffs), len(x))))
+    values = values + noise[:, None]
+    low, high = np.percentile(values, [50 * (1 - level), 50 * (1 + level)], axis=0)
+    return low, high
+
+
+# Polynomial models of every route kept as least squares sufficient statistics,
+# month by month: for the basis t = (x - center) / |center| of each route
+# (center is the mean of the first rows of the route), the sums of t^i t^j, t^i y, y, y²
+# and the number of rows. Adding a month costs its number of rows and a month
+# can be removed again (sliding windows), the models are solved from the sums.
+# Rows without a date are kept in an undated bucket (named like the undated
+# partitions of the store): it is replaced when rows without a date are added
+# again, but never removed, so a window always has them like a full refit.
+# Unlike Predict, the models use every row of the months added (no test split)
+# and R² / RMSE are computed on these rows.
+class OnlineModels:
+    def __init__(self, type1, type2, degree=3):
+        self.type1 = type1
+        self.type2 = type2
+        self.degree = degree
+        size = len(STATION_DTYPE.categories) ** 2
+        k = degree + 1
+        self.center = np.full(size, np.nan)
+        self.scale = np.ones(size)
+        self.xtx = np.zeros((size, k, k))
+        self.xty = np.zeros((size, k))
+        self.ysum = np.zeros(size)
+        self.yty = np.zeros(size)
+        self.n = np.zeros(size, dtype="int64")
+        # month -> (pairs, their sums), to remove a month exactly as it was added
+        self.months = {}
+
+    def _stats(self, pairs, x, y):
+        if np.isnan(self.center[pairs]).any():
+            new = np.unique(pairs[np.isnan(self.center[pairs])])
+            for pair in new:
+                center = x[pairs == pair].mean()
+                self.center[pair] = center
+                self.scale[pair] = max(abs(center), 1.0)
+        t = (x - self.center[pairs]) / self.scale[pairs]
+        basis = t[:, None] ** np.arange(self.degree + 1)
+        used, groups = np.unique(pairs, return_inverse=True)
+        k = self.degree + 1
+        xtx = np.zeros((len(used), k, k))
+        xty = np.zeros((len(used), k))
+        np.add.at(xtx, groups, basis[:, :, None] * basis[:, None, :])
+        np.add.at(xty, groups, basis * y[:, None])
+        ysum = np.bincount(groups, weights=y, minlength=len(used))
+        yty = np.bincount(groups, weights=y * y, minlength=len(used))
+        n = np.bincount(groups, minlength=len(used))
+        return used, (xtx, xty, ysum, yty, n)
+
+    def _apply(self, pairs, stats, sign):
+        xtx, xty, ysum, yty, n = stats
+        self.xtx[pairs] += sign * xtx
+        self.xty[pairs] += sign * xty
+        self.ysum[pairs] += sign * ysum
+        self.yty[pairs] += sign * yty
+        self.n[pairs] += sign * n
+
+    # Adds the rows of the frame, month by month ("Date" column), the rows without
+    # a date in the undated bucket. A month or bucket that was already added is
+    # replaced. Returns the months (and bucket) added.
+    def add(self, csv, undated=UNDATED):
+        x = csv[self.type1].to_numpy(dtype="float64", na_value=np.nan)
+        y = csv[self.type2].to_numpy(dtype="float64", na_value=np.nan)
+        departure = station_codes(csv["Departure station"])
+        arrival = station_codes(csv["Arrival station"])
+        month = csv["Date"].dt.strftime("%Y-%m").fillna(undated).to_numpy(dtype=object)
+        valid = (departure >= 0) & (arrival >= 0) & ~np.isnan(x) & ~np.isnan(y)
+        pair = departure * len(STATION_DTYPE.categories) + arrival
+        added = sorted(set(month[valid]))
+        for name in added:
+            rows = valid & (month == name)
+            self._drop(name)
+            pairs, stats = self._stats(pair[rows], x[rows], y[rows])
+            self._apply(pairs, stats, 1)
+            self.months[name] = (pairs, stats)
+        return added
+
+    # Takes a month out of the models. Rows without a date can't be removed.
+    def remove(self, month):
+        if is_undated(month):
+            raise ValueError("rows without a date are kept in every window")
+        self._drop(month)
+
+    def _drop(self, month):
+        if month in self.months:
+            pairs, stats = self.months.pop(month)
+            self._apply(pairs, stats, -1)
+
+    # Models of every route with rows: same columns as fit_routes, except
+    # n_train (every row is used) and the prediction at the mean of type1.
+    def fit(self):
+        pairs = np.flatnonzero(self.n > 0)
+        # the normal equations are scaled by their diagonal before being solved
+        diagonal = np.sqrt(np.einsum("gii->gi", self.xtx[pairs]))
+        diagonal[diagonal == 0] = 1.0
+        scaled = self.xtx[pairs] / diagonal[:, :, None] / diagonal[:, None, :]
+        coeffs_t = (
+            np.einsum(
+                "gij,gj->gi",
+                np.linalg.pinv(scaled, hermitian=True),
+                self.xty[pairs] / diagonal,
+            )
+            / diagonal
+        )
+        n = self.n[pairs]
+        # residual and total sums of squares from the sums
+        residual = (
+            self.yty[pairs]
+            - 2 * np.einsum("gi,gi->g", coeffs_t, self.xty[pairs])
+            + np.einsum("gi,gij,gj->g", coeffs_t, self.xtx[pairs], coeffs_t)
+        )
+        total = self.yty[pairs] - self.ysum[pairs] ** 2 / n
+        # below the rounding error of the sums, the sums of squares are 0: a
+        # constant target fitted exactly has R² = 1, like with batch_scores
+        tiny = ONLINE_ROUNDING * self.yty[pairs]
+        residual = np.where(residual > tiny, residual, 0.0)
+        total = np.where(total > tiny, total, 0.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r2 = np.where(total > 0, 1 - residual / total, (residual == 0) * 1.0)
+        r2[n < 2] = np.nan
+        rmse = np.sqrt(residual / n)
+
+        # coefficients of x (highest power first) from the ones of t
+        coeffs = np.empty_like(coeffs_t)
+        for i, pair in enumerate(pairs):
+            t = np.poly1d([1 / self.scale[pair], -self.center[pair] / self.scale[pair]])
+            x_poly = np.poly1d(coeffs_t[i, ::-1])(t)
+            coeffs[i] = np.pad(x_poly.coeffs, (self.degree + 1 - len(x_poly.coeffs), 0))
+
+        stations = STATION_DTYPE.categories
+        departure, arrival = np.divmod(pairs, len(stations))
+        table = pd.DataFrame(
+            {
+                "Departure station": stations[departure],
+                "Arrival station": stations[arrival],
+                "n": n,
+            }
+        )
+        for power, column in zip(range(self.degree, -1, -1), coeffs.T):
+            table[f"x^{power}"] = column
+        table["r2"] = r2
+        table["rmse"] = rmse
+        return table
+
+
+if __name__ == "__main__":
+    from storage import load_dataset
+
+    type1 = "Number of scheduled trains"
+    type2 = "Number of trains delayed at departure"
+    csv = load_dataset(["Departure station", "Arrival station", type1, type2])
+    if csv is None:
+        print("No cleaned dataset, run incremental.py first.")
+    else:
+        print(fit_routes(csv, type1, type2).head(20).to_string())
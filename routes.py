@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+from storage import STATION_DTYPE
+
+
+# Index of the routes of a loaded frame, built once when the data is loaded:
+# - the arrival stations of each departure station, in alphabetical order
+# - the departure stations of each arrival station, in alphabetical order
+# - the positions of the rows of each departure/arrival pair in the frame
+# The positions of all the pairs are kept in one array, sorted by pair and then
+# by position, so the rows of a pair are a slice of it (in the order of the
+# frame, by date) and looking them up doesn't depend on the size of the frame.
+class RouteIndex:
+    def __init__(self, csv):
+        departure = station_codes(csv["Departure station"])
+        arrival = station_codes(csv["Arrival station"])
+        pair = np.where(
+            (departure >= 0) & (arrival >= 0),
+            departure * len(STATION_DTYPE.categories) + arrival,
+            -1,
+        )
+        order = np.argsort(pair, kind="stable")
+        order = order[pair[order] >= 0]
+        pairs, starts = np.unique(pair[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        stations = STATION_DTYPE.categories
+        self.positions = order
+        self.slices = {}
+        self.arrivals = {}
+        self.departures = {}
+        for code, start, end in zip(pairs, starts, ends):
+            dep, arr = divmod(int(code), len(stations))
+            dep, arr = stations[dep], stations[arr]
+            self.slices[(dep, arr)] = (int(start), int(end))
+            self.arrivals.setdefault(dep, []).append(arr)
+            self.departures.setdefault(arr, []).append(dep)
+        for neighbours in (self.arrivals, self.departures):
+            for station in neighbours:
+                neighbours[station].sort()
+
+    # Arrival stations reachable from any of the departure stations.
+    def arrivals_of(self, departure_stations):
+        return sorted(
+            {arr for dep in departure_stations for arr in self.arrivals.get(dep, [])}
+        )
+
+    # Departure stations that lead to any of the arrival stations.
+    def departures_of(self, arrival_stations):
+        return sorted(
+            {dep for arr in arrival_stations for dep in self.departures.get(arr, [])}
+        )
+
+    # Positions in the frame of the rows of one pair (a view, not a copy).
+    def pair_rows(self, departure, arrival):
+        start, end = self.slices.get((departure, arrival), (0, 0))
+        return self.positions[start:end]
+
+    # Positions in the frame of the rows of every pair between the stations,
+    # in the order of the frame.
+    def rows(self, departure_stations, arrival_stations):
+        parts = [
+            self.pair_rows(dep, arr)
+            for dep in departure_stations
+            for arr in arrival_stations
+            if (dep, arr) in self.slices
+        ]
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return self.positions[:0]
+        return np.sort(np.concatenate(parts))
+
+    # Rows of every pair between the stations. When they are one slice of the
+    # frame (one pair of a frame sorted by route, like the memory-mapped dataset)
+    # this is a view of the frame, not a copy.
+    def select(self, csv, departure_stations, arrival_stations):
+        rows = self.rows(departure_stations, arrival_stations)
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            return csv.iloc[rows[0] : rows[-1] + 1]
+        return csv.iloc[rows]
+
+
+# Codes of the station names in the station list (-1 for any other name).
+def station_codes(series):
+    if series.dtype != STATION_DTYPE:
+        series = series.astype(STATION_DTYPE)
+    return series.cat.codes.to_numpy().astype("int64")
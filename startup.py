@@ -0,0 +1,129 @@
+import argparse
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+APP_FILE = "tardis_dashboard.py"
+# Pages visited in order, each for the first time in the process.
+PAGES = ["home", "data", "pred", "planner", "user's"]
+# Fresh processes measured, the best time of each is kept.
+REPEAT = 3
+TOP = 15
+TIMEOUT = 120
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+# Run in a new interpreter: time to import Streamlit, then time of the first run
+# of each page (its imports and its data loads included) with AppTest.
+FIRST_VISITS = """
+import json, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+times = {"import streamlit": time.perf_counter() - start}
+at = AppTest.from_file(sys.argv[1], default_timeout=float(sys.argv[2]))
+for page in sys.argv[3:]:
+    at.session_state.page = page
+    start = time.perf_counter()
+    at.run()
+    times[page] = time.perf_counter() - start
+    if at.exception:
+        raise SystemExit(f"{page}: {at.exception[0].value}")
+print(json.dumps(times))
+"""
+
+
+# Import time of the script and of every module it imports on its first run (the
+# home page), in a new interpreter with python -X importtime: time of the module
+# itself and with its own imports (s), and depth in the import tree.
+def import_times(app_file=APP_FILE):
+    path = Path(app_file).resolve()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {path.stem}"],
+        cwd=path.parent,
+        capture_output=True,
+        text=True,
+        timeout=TIMEOUT,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append(
+                {
+                    "module": module,
+                    "package": module.split(".")[0],
+                    "depth": len(indent) // 2,
+                    "self s": int(self_us) / 1e6,
+                    "cumulative s": int(cumulative_us) / 1e6,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+# Time of the first visit of each page (s) in new processes, best of repeat.
+def first_visits(app_file=APP_FILE, pages=PAGES, repeat=REPEAT):
+    path = Path(app_file).resolve()
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", FIRST_VISITS, path.name, str(TIMEOUT), *pages],
+            cwd=path.parent,
+            capture_output=True,
+            text=True,
+            timeout=TIMEOUT * (len(pages) + 1),
+        )
+        if result.returncode:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return pd.DataFrame(runs).min()
+
+
+# Import time by top-level package (time of their own modules), and the direct
+# imports of the script with their cumulative time.
+def breakdown(times, top=TOP):
+    packages = (
+        times.groupby("package")["self s"].sum().sort_values(ascending=False).head(top)
+    )
+    direct = times[times["depth"] == 1].sort_values("cumulative s", ascending=False)
+    return packages, direct.set_index("module")["cumulative s"].head(top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import-time breakdown and first visit time of the dashboard pages."
+    )
+    parser.add_argument("--app", default=APP_FILE)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--top", type=int, default=TOP)
+    parser.add_argument("--output", help="write the report (JSON)")
+    args = parser.parse_args()
+
+    times = import_times(args.app)
+    packages, direct = breakdown(times, args.top)
+    visits = first_visits(args.app, repeat=args.repeat)
+    total = times[times["depth"] == 0]["cumulative s"].sum()
+    print(f"Imports of the first run: {total:.2f} s")
+    print("\nBy package (own modules):")
+    print(packages.to_string(float_format="{:.3f}".format))
+    print("\nImported by the script (with their imports):")
+    print(direct.to_string(float_format="{:.3f}".format))
+    print("\nFirst visit of each page, in a new process (s):")
+    print(visits.to_string(float_format="{:.3f}".format))
+    print(
+        f"Home page painted {visits['import streamlit'] + visits['home']:.2f} s "
+        "after the start of the process"
+    )
+    if args.output:
+        report = {
+            "imports s": total,
+            "packages": packages.to_dict(),
+            "direct imports": direct.to_dict(),
+            "first visits": visits.to_dict(),
+            "modules": times.to_dict("records"),
+        }
+        Path(args.output).write_text(json.dumps(report, indent=1), encoding="utf-8")
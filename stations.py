@@ -0,0 +1,65 @@
+# Canonical names used everywhere: the cleaning maps every raw spelling to one of
+# them and the dashboard offers them in its selectors.
+SERVICES = ["NATIONAL", "INTERNATIONAL"]
+
+STATIONS = [
+    "AIX EN PROVENCE TGV",
+    "ANGERS SAINT LAUD",
+    "ANGOULEME",
+    "ANNECY",
+    "ARRAS",
+    "AVIGNON TGV",
+    "BARCELONA",
+    "BELLEGARDE (AIN)",
+    "BESANCON FRANCHE COMTE TGV",
+    "BORDEAUX ST JEAN",
+    "BREST",
+    "CHAMBERY CHALLES LES EAUX",
+    "DIJON VILLE",
+    "DOUAI",
+    "DUNKERQUE",
+    "FRANCFORT",
+    "GENEVE",
+    "GRENOBLE",
+    "ITALIE",
+    "LA ROCHELLE VILLE",
+    "LAUSANNE",
+    "LAVAL",
+    "LE CREUSOT MONTCEAU MONTCHANIN",
+    "LE MANS",
+    "LILLE",
+    "LYON PART DIEU",
+    "MACON LOCHE",
+    "MADRID",
+    "MARNE LA VALLEE",
+    "MARSEILLE ST CHARLES",
+    "METZ",
+    "MONTPELLIER",
+    "MULHOUSE VILLE",
+    "NANCY",
+    "NANTES",
+    "NICE VILLE",
+    "NIMES",
+    "PARIS EST",
+    "PARIS LYON",
+    "PARIS MONTPARNASSE",
+    "PARIS NORD",
+    "PARIS VAUGIRARD",
+    "PERPIGNAN",
+    "POITIERS",
+    "QUIMPER",
+    "REIMS",
+    "RENNES",
+    "SAINT ETIENNE CHATEAUCREUX",
+    "ST MALO",
+    "ST PIERRE DES CORPS",
+    "STRASBOURG",
+    "STUTTGART",
+    "TOULON",
+    "TOULOUSE MATABIAU",
+    "TOURCOING",
+    "TOURS",
+    "VALENCE ALIXAN TGV",
+    "VANNES",
+    "ZURICH",
+]
@@ -0,0 +1,458 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from stations import SERVICES, STATIONS
+
+STORE_DIR = "cleaned"
+CSV_FILE = "cleaned_dataset.csv"
+MANIFEST_FILE = "manifest.json"
+MAPPED_FILE = "dataset.arrow"
+# Bumped when the layout of the mapped file changes, so that old files are
+# written again.
+MAPPED_VERSION = 2
+# Column of the mapped file with the partition of each row (not loaded).
+PARTITION_COLUMN = "partition"
+UNDATED = "undated"
+# Name used by hive partitioning for missing values (rows without a date).
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+CATEGORY_COLUMNS = ["Service", "Departure station", "Arrival station"]
+
+# Fixed dictionaries shared by every loaded frame: the codes of a station are the
+# same in the departure and arrival columns and from one load to another.
+SERVICE_DTYPE = pd.CategoricalDtype(SERVICES)
+STATION_DTYPE = pd.CategoricalDtype(STATIONS)
+
+
+# The cleaned store is a parquet dataset partitioned by year and month:
+# cleaned/year=2018/month=01/part-0.parquet, with a manifest.json listing the months.
+# Rows without a date are kept apart for each raw source ("undated-<source>"
+# partitions, see undated_partition), in files of the null partition.
+def partition_file(store, month):
+    name = "part-0.parquet"
+    if is_undated(month):
+        year = number = NULL_PARTITION
+        if month != UNDATED:
+            name = f"part-{month[len(UNDATED) + 1 :]}.parquet"
+    else:
+        year, number = month.split("-")
+    return Path(store) / f"year={year}" / f"month={number}" / name
+
+
+# Partition of the rows without a date of a raw source, named after its path.
+def undated_partition(source):
+    key = str(Path(source).resolve()).encode("utf-8")
+    return f"{UNDATED}-{hashlib.sha1(key).hexdigest()[:12]}"
+
+
+def is_undated(month):
+    return month == UNDATED or month.startswith(UNDATED + "-")
+
+
+# Temporary file next to path, unique to the process and the thread. Files are
+# written in it and then moved over path: concurrent writers of the same file
+# never share a temporary file, and readers never see a partial one.
+def temp_path(path):
+    path = Path(path)
+    return path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+
+
+def load_manifest(store=STORE_DIR):
+    path = Path(store) / MANIFEST_FILE
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    return {"signature": None, "partitions": {}}
+
+
+def save_manifest(store, manifest):
+    path = Path(store) / MANIFEST_FILE
+    tmp = temp_path(path)
+    tmp.write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding="utf-8")
+    tmp.replace(path)
+
+
+# Months of the store in chronological order, rows without a date last
+# (same order as the sorted csv).
+def store_months(store=STORE_DIR):
+    months = sorted(load_manifest(store)["partitions"])
+    return [m for m in months if not is_undated(m)] + [
+        m for m in months if is_undated(m)
+    ]
+
+
+# Replaces the file of one month. Dates keep their datetime type and the
+# station and service names are stored as dictionaries (categoricals).
+def write_partition(store, month, csv):
+    path = partition_file(store, month)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    csv = csv.astype({column: "category" for column in CATEGORY_COLUMNS})
+    tmp = temp_path(path)
+    pq.write_table(pa.Table.from_pandas(csv, preserve_index=False), tmp)
+    tmp.replace(path)
+
+
+# Smallest nullable integer type that holds every value of a count column.
+def _count_dtype(values):
+    values = values.dropna()
+    if values.empty:
+        return "UInt8"
+    dtype = np.result_type(
+        np.min_scalar_type(int(values.min())), np.min_scalar_type(int(values.max()))
+    )
+    return ("UInt" if dtype.kind == "u" else "Int") + str(dtype.itemsize * 8)
+
+
+# Compact in-memory representation of the cleaned data:
+# - service and station names as categoricals of the fixed dictionaries
+#   (names that are not in them, like empty ones, become missing values)
+# - counts of trains in the smallest integer type that fits
+# - percentages in float32
+# The memory used before and after is kept in csv.attrs["memory"].
+def compact(csv):
+    before = int(csv.memory_usage(deep=True).sum())
+    dtypes = {}
+    for column in csv.columns:
+        if column == "Service":
+            dtypes[column] = SERVICE_DTYPE
+        elif column in CATEGORY_COLUMNS:
+            dtypes[column] = STATION_DTYPE
+        elif column.startswith("Number of"):
+            dtypes[column] = _count_dtype(csv[column])
+        elif column.startswith("Pct") or column == "Total Pct":
+            dtypes[column] = "float32"
+    csv = csv.astype(dtypes)
+    csv.attrs["memory"] = {
+        "before": before,
+        "after": int(csv.memory_usage(deep=True).sum()),
+    }
+    return csv
+
+
+# Fingerprint of the cleaned data: the content hashes of the months of the store,
+# or the size and date of the csv file when there is no store (None without data).
+# Anything computed from the data and saved can be keyed on it.
+def data_fingerprint(store=STORE_DIR, csv_file=CSV_FILE):
+    manifest = load_manifest(store)
+    if manifest["partitions"]:
+        content = {
+            month: info["hash"] for month, info in manifest["partitions"].items()
+        }
+        data = [manifest["signature"], content]
+    else:
+        path = Path(csv_file)
+        if not path.exists():
+            return None
+        data = [str(path.resolve()), path.stat().st_size, path.stat().st_mtime_ns]
+    key = json.dumps(data, sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def dataset_available(store=STORE_DIR, csv_file=CSV_FILE):
+    if load_manifest(store)["partitions"]:
+        return True
+    path = Path(csv_file)
+    return path.exists() and path.stat().st_size > 0
+
+
+# Loads the cleaned dataset with only the given columns and, when dates is a
+# ("YYYY-MM", "YYYY-MM") range, only the months of that range: the other
+# partitions are never opened. Falls back on the csv file when there is no store.
+# The frame is made compact unless compact_frame is False.
+# With mapped=True the frame is read from the memory-mapped file instead (see
+# load_mapped): always compact, rows sorted by route.
+# Returns None if no dataset is available.
+def load_dataset(
+    columns=None,
+    dates=None,
+    store=STORE_DIR,
+    csv_file=CSV_FILE,
+    compact_frame=True,
+    mapped=False,
+):
+    if mapped:
+        csv = load_mapped(columns, store, csv_file)
+        if csv is not None and dates is not None:
+            month = csv["Date"].dt.strftime("%Y-%m")
+            csv = csv[(month >= dates[0]) & (month <= dates[1])]
+        return csv
+    csv = _read(columns, dates, store, csv_file)
+    if csv is None or not compact_frame:
+        return csv
+    return compact(csv)
+
+
+def _read(columns, dates, store, csv_file):
+    months = store_months(store)
+    if months:
+        if dates is not None:
+            months = [
+                m for m in months if not is_undated(m) and dates[0] <= m <= dates[1]
+            ]
+        if not months:
+            return read_partitions(store, store_months(store)[:1], columns).iloc[:0]
+        return read_partitions(store, months, columns)
+
+    path = Path(csv_file)
+    if not path.exists() or path.stat().st_size == 0:
+        return None
+    dates_columns = ["Date"] if columns is None or "Date" in columns else False
+    csv = pd.read_csv(path, usecols=columns, parse_dates=dates_columns)
+    if dates is not None:
+        month = csv["Date"].dt.strftime("%Y-%m")
+        csv = csv[(month >= dates[0]) & (month <= dates[1])]
+    return csv
+
+
+# Rows of the given partitions of the store, one after the other, read like
+# load_dataset reads them (not compact).
+def read_partitions(store, months, columns=None):
+    paths = [partition_file(store, month) for month in months]
+    tables = [pq.ParquetFile(path).read(columns=columns) for path in paths]
+    table = pa.concat_tables(tables, promote_options="permissive")
+    # without the pandas metadata, counts come back as plain float64 like with
+    # read_csv instead of the slower nullable Int64
+    return table.to_pandas(ignore_metadata=True)
+
+
+# The compact frame is also written once in an Arrow IPC file (uncompressed) that
+# every process memory-maps: the processes of a deployment share the same pages
+# of the page cache instead of holding one copy of the dataset each.
+# Columns are stored as plain arrays without nulls, so that pandas uses them
+# without copying:
+# - categoricals as their codes (-1 for missing values)
+# - nullable counts as their values and a "<column>.mask" column
+# - dates as int64 nanoseconds (NaT included)
+# Rows are sorted by departure/arrival pair (in the order of the data within a
+# pair): the rows of a route are one slice of the frame (see RouteIndex.select).
+def mapped_file(store=STORE_DIR, csv_file=CSV_FILE):
+    if load_manifest(store)["partitions"]:
+        return Path(store) / MAPPED_FILE
+    return Path(csv_file).with_suffix(".arrow")
+
+
+def write_mapped(path, csv, key, partition=None, partitions=None):
+    order = np.argsort(_pair_codes(csv), kind="stable")
+    arrays, kinds = _mapped_arrays(csv.iloc[order])
+    if partition is not None:
+        arrays[PARTITION_COLUMN] = partition[order].astype("int16")
+    _write_mapped_table(path, arrays, kinds, key, partitions)
+
+
+def _pair_codes(csv):
+    codes = csv["Departure station"].cat.codes.to_numpy().astype("int64")
+    return codes * len(STATIONS) + csv["Arrival station"].cat.codes.to_numpy()
+
+
+# Arrays of the columns of a compact frame as they are stored in the mapped file,
+# and the kind of each column (its pandas dtype).
+def _mapped_arrays(csv):
+    arrays = {}
+    kinds = {}
+    for column in csv.columns:
+        series = csv[column]
+        if column == "Service" or column in CATEGORY_COLUMNS:
+            arrays[column] = series.cat.codes.to_numpy()
+        elif isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+            dtype = series.dtype.numpy_dtype
+            arrays[column] = series.to_numpy(dtype=dtype, na_value=0)
+            arrays[column + ".mask"] = series.isna().to_numpy().view("uint8")
+        elif series.dtype.kind == "M":
+            arrays[column] = series.to_numpy().view("int64")
+        elif series.dtype.kind == "O":
+            arrays[column] = pa.array(series, type=pa.string())
+        else:
+            arrays[column] = series.to_numpy()
+        kinds[column] = str(series.dtype)
+    return arrays, kinds
+
+
+def _write_mapped_table(path, arrays, kinds, key, partitions=None):
+    metadata = {"key": key, "columns": json.dumps(kinds)}
+    if partitions is not None:
+        metadata["partitions"] = json.dumps(partitions)
+    table = pa.table(arrays).replace_schema_metadata(metadata)
+    tmp = temp_path(path)
+    with pa.OSFile(str(tmp), "wb") as out:
+        with pa.ipc.new_file(out, table.schema) as writer:
+            writer.write_table(table)
+    tmp.replace(path)
+
+
+def _open_mapped(path):
+    return pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+
+
+# Column of the mapped table as a series that uses the mapped pages (read-only).
+def _mapped_column(table, column, kind):
+    values = table.column(column).combine_chunks()
+    if kind == "object":
+        return pd.Series(values.to_pandas(), name=column)
+    values = values.to_numpy(zero_copy_only=True)
+    if kind == "category":
+        dtype = SERVICE_DTYPE if column == "Service" else STATION_DTYPE
+        values = pd.Categorical.from_codes(values, dtype=dtype, validate=False)
+    elif kind.startswith("datetime64"):
+        values = values.view(kind)
+    elif column + ".mask" in table.column_names:
+        mask = table.column(column + ".mask").combine_chunks()
+        mask = mask.to_numpy(zero_copy_only=True).view(bool)
+        values = pd.arrays.IntegerArray(values, mask)
+    return pd.Series(values, name=column, copy=False)
+
+
+# Mapped file of the store. Each row also has the position of its partition in
+# the list of partitions kept in the metadata with their hashes, so that the next
+# version of the store is written from this one: the rows of the partitions that
+# changed or left the store are dropped and the rows of the changed partitions
+# are read and merged in by route. The other partitions are copied from the
+# mapped pages, they are not read nor made compact again.
+def _write_store_mapped(path, store, key, previous=None):
+    manifest = load_manifest(store)
+    months = store_months(store)
+    partitions = {
+        "signature": manifest["signature"],
+        "months": months,
+        "hashes": [manifest["partitions"][m]["hash"] for m in months],
+    }
+    if previous is not None and _update_mapped(path, previous, partitions, store, key):
+        return
+    csv = load_dataset(store=store)
+    counts = [
+        pq.ParquetFile(partition_file(store, m)).metadata.num_rows for m in months
+    ]
+    partition = np.repeat(np.arange(len(months)), counts)
+    write_mapped(path, csv, key, partition, partitions)
+
+
+# Writes the mapped file of partitions from the previous one (see
+# _write_store_mapped). Returns False when it has to be written from the whole
+# store instead: other version or cleaning, or columns that don't match.
+def _update_mapped(path, previous, partitions, store, key):
+    metadata = previous.schema.metadata
+    before = json.loads(metadata.get(b"partitions", b"null"))
+    version = metadata[b"key"].decode().split("-")[0]
+    if before is None or version != str(MAPPED_VERSION):
+        return False
+    if before["signature"] != partitions["signature"]:
+        return False
+    months = partitions["months"]
+    hashes = dict(zip(months, partitions["hashes"]))
+    position = {month: i for i, month in enumerate(months)}
+    before_hashes = dict(zip(before["months"], before["hashes"]))
+    changed = [m for m in months if before_hashes.get(m) != hashes[m]]
+    # position of the old partitions in the new list, -1 when they are dropped
+    old_position = np.array(
+        [
+            position[m] if hashes.get(m) == h else -1
+            for m, h in zip(before["months"], before["hashes"])
+        ],
+        dtype="int64",
+    )
+
+    old_partition = previous.column(PARTITION_COLUMN).to_numpy()
+    rank = old_position[old_partition]
+    kept = rank >= 0
+    kinds = json.loads(metadata[b"columns"])
+    if changed:
+        csv = compact(read_partitions(store, changed))
+        counts = [
+            pq.ParquetFile(partition_file(store, m)).metadata.num_rows for m in changed
+        ]
+        new_rank = np.repeat([position[m] for m in changed], counts)
+        new_arrays, new_kinds = _mapped_arrays(csv)
+        if set(new_kinds) != set(kinds):
+            return False
+    else:
+        new_rank = np.zeros(0, dtype="int64")
+        new_arrays = None
+
+    arrays = {}
+    for column in previous.column_names:
+        if column == PARTITION_COLUMN:
+            continue
+        values = previous.column(column).combine_chunks().to_numpy()[kept]
+        if new_arrays is not None:
+            values = np.concatenate([values, new_arrays[column]])
+        arrays[column] = values
+    for column, kind in kinds.items():
+        if new_arrays is not None and new_kinds[column] != kind:
+            kind = _merged_kind(kind, new_kinds[column], arrays[column].dtype)
+            if kind is None:
+                return False
+            kinds[column] = kind
+
+    rank = np.concatenate([rank[kept], new_rank])
+    pair = arrays["Departure station"].astype("int64") * len(STATIONS)
+    pair += arrays["Arrival station"]
+    # by route, then in the order of the store within a route
+    order = np.lexsort((rank, pair))
+    arrays = {column: values[order] for column, values in arrays.items()}
+    arrays[PARTITION_COLUMN] = rank[order].astype("int16")
+    _write_mapped_table(path, arrays, kinds, key, partitions)
+    return True
+
+
+# Kind of a count column whose values of two kinds were put together, None when
+# they can't be (not two nullable integer kinds).
+def _merged_kind(kind, other, dtype):
+    if not (kind[:3] in ("Int", "UIn") and other[:3] in ("Int", "UIn")):
+        return None
+    return ("UInt" if dtype.kind == "u" else "Int") + str(dtype.itemsize * 8)
+
+
+# Returns the cleaned dataset from the memory-mapped file, with only the given
+# columns: only the pages that are used are read. The file is written again
+# when the data changed since it was written (for a store, from the previous
+# file and the partitions that changed, see _write_store_mapped).
+# Returns None if no dataset is available.
+def load_mapped(columns=None, store=STORE_DIR, csv_file=CSV_FILE):
+    fingerprint = data_fingerprint(store, csv_file)
+    if fingerprint is None:
+        return None
+    key = f"{MAPPED_VERSION}-{fingerprint}"
+    path = mapped_file(store, csv_file)
+    table = _open_mapped(path) if path.exists() else None
+    if table is None or table.schema.metadata[b"key"].decode() != key:
+        if load_manifest(store)["partitions"]:
+            _write_store_mapped(path, store, key, table)
+        else:
+            csv = load_dataset(store=store, csv_file=csv_file)
+            if csv is None:
+                return None
+            write_mapped(path, csv, key)
+        table = _open_mapped(path)
+    kinds = json.loads(table.schema.metadata[b"columns"])
+    columns = list(kinds) if columns is None else columns
+    return pd.concat(
+        [_mapped_column(table, column, kinds[column]) for column in columns],
+        axis=1,
+        copy=False,
+    )
+
+
+if __name__ == "__main__":
+    csv = load_dataset(compact_frame=False)
+    if csv is None:
+        print("No cleaned dataset, run incremental.py first.")
+    else:
+        small = compact(csv)
+        sizes = pd.DataFrame(
+            {
+                "before": csv.memory_usage(deep=True, index=False),
+                "after": small.memory_usage(deep=True, index=False),
+                "dtype": small.dtypes,
+            }
+        )
+        print(sizes.to_string())
+        memory = small.attrs["memory"]
+        print(
+            f"Memory: {memory['before'] / 2**20:.2f} MB -> "
+            f"{memory['after'] / 2**20:.2f} MB"
+        )
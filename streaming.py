@@ -0,0 +1,167 @@
+import argparse
+import heapq
+import tempfile
+from operator import itemgetter
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cleaning import CanonicalCache, clean
+
+KEY_COLUMNS = ["_date", "Service", "Departure station", "Arrival station", "_fp"]
+
+# Maximum number of sorted runs merged at once.
+FAN_IN = 16
+
+
+# Number of raw rows read at once so that a chunk stays under the memory budget.
+# A chunk is held about four times while it is cleaned, fingerprinted and sorted.
+def rows_per_chunk(source, max_memory_mb, sep=";"):
+    sample = pd.read_csv(source, sep=sep, nrows=1000)
+    row_size = sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+    return max(1000, int(max_memory_mb * 2**20 / (row_size * 4)))
+
+
+# Adds the sort keys of each row: the date as an integer (missing dates last,
+# like sort_values) and a 64 bits fingerprint of the whole cleaned row.
+# Two identical rows have the same keys, so they end up next to each other
+# once sorted and are removed without keeping every fingerprint in memory.
+def add_keys(csv):
+    fp = pd.util.hash_pandas_object(csv, index=False).to_numpy()
+    date = csv["Date"].to_numpy(dtype="datetime64[ns]").view("int64")
+    csv["_date"] = np.where(csv["Date"].isna(), np.iinfo("int64").max, date)
+    csv["_fp"] = fp
+    csv = csv[~csv["_fp"].duplicated()]
+    return csv.sort_values(KEY_COLUMNS, kind="stable", ignore_index=True)
+
+
+def write_run(csv, directory, number):
+    path = Path(directory) / f"run_{number:06d}.parquet"
+    pq.write_table(pa.Table.from_pandas(csv, preserve_index=False), path)
+    return path
+
+
+# Yields the rows of a sorted run, reading it batch by batch.
+def read_run(path, batch_rows):
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows):
+        frame = batch.to_pandas()
+        yield from zip(*(frame[column].tolist() for column in frame.columns))
+
+
+# Merges sorted runs and yields the rows in sorted order, without duplicates.
+def merge_runs(paths, columns, batch_rows):
+    key = itemgetter(*(columns.index(column) for column in KEY_COLUMNS))
+    last = None
+    for row in heapq.merge(*(read_run(path, batch_rows) for path in paths), key=key):
+        if key(row) != last:
+            last = key(row)
+            yield row
+
+
+# Groups merged rows back into dataframes of at most batch_rows rows.
+def batches(rows, columns, dtypes, batch_rows):
+    buffer = []
+    for row in rows:
+        buffer.append(row)
+        if len(buffer) >= batch_rows:
+            yield pd.DataFrame(buffer, columns=columns).astype(dtypes)
+            buffer = []
+    if buffer:
+        yield pd.DataFrame(buffer, columns=columns).astype(dtypes)
+
+
+# Cleans a raw export that doesn't fit in memory.
+# The source is read in chunks of bounded size (quoted multi-line comments are
+# handled by the csv parser), each chunk is cleaned, deduplicated and sorted
+# into a run on disk, then the runs are merged FAN_IN at a time until the
+# sorted output can be written. Memory depends on max_memory_mb, not on the input.
+def clean_stream(
+    source,
+    output="cleaned_dataset.csv",
+    max_memory_mb=256,
+    sep=";",
+    tmp_dir=None,
+    cache=None,
+):
+    chunk_rows = rows_per_chunk(source, max_memory_mb, sep)
+    batch_rows = max(100, chunk_rows // (FAN_IN + 1))
+    cache = cache if cache is not None else CanonicalCache()
+    stats = {"rows_read": 0, "rows_written": 0, "runs": 0}
+    reports = []
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        runs = []
+        columns = dtypes = None
+        for chunk in pd.read_csv(source, sep=sep, chunksize=chunk_rows):
+            stats["rows_read"] += len(chunk)
+            chunk, report = clean(chunk, cache)
+            reports.append(report)
+            chunk = add_keys(chunk)
+            columns, dtypes = list(chunk.columns), chunk.dtypes.to_dict()
+            runs.append(write_run(chunk, directory, len(runs)))
+        cache.save()
+        stats["runs"] = len(runs)
+
+        while len(runs) > FAN_IN:
+            merged = []
+            for i in range(0, len(runs), FAN_IN):
+                rows = merge_runs(runs[i : i + FAN_IN], columns, batch_rows)
+                path = (
+                    Path(directory) / f"merge_{stats['runs'] + len(merged):06d}.parquet"
+                )
+                writer = None
+                for frame in batches(rows, columns, dtypes, batch_rows):
+                    table = pa.Table.from_pandas(frame, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(path, table.schema)
+                    writer.write_table(table)
+                if writer is not None:
+                    writer.close()
+                    merged.append(path)
+                for run in runs[i : i + FAN_IN]:
+                    run.unlink()
+            stats["runs"] += len(merged)
+            runs = merged
+
+        with open(output, "w", encoding="utf-8", newline="") as out:
+            header = True
+            rows = merge_runs(runs, columns, batch_rows) if runs else []
+            for frame in batches(rows, columns, dtypes, batch_rows):
+                frame = frame.drop(columns=["_date", "_fp"])
+                frame.to_csv(out, index=False, header=header)
+                stats["rows_written"] += len(frame)
+                header = False
+
+    report = (
+        pd.concat(reports).groupby(["column", "rule"], sort=False, as_index=False).sum()
+        if reports
+        else None
+    )
+    return stats, report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Clean a raw SNCF export in bounded memory."
+    )
+    parser.add_argument("source", nargs="?", default="assets/dataset.csv")
+    parser.add_argument("output", nargs="?", default="cleaned_dataset.csv")
+    parser.add_argument(
+        "--max-memory", type=int, default=256, help="memory budget in MB"
+    )
+    parser.add_argument("--tmp-dir", default=None, help="where sorted runs are kept")
+    args = parser.parse_args()
+
+    stats, report = clean_stream(
+        args.source, args.output, args.max_memory, tmp_dir=args.tmp_dir
+    )
+    if report is not None:
+        print(report[report["rejected"] > 0].to_string(index=False))
+    print(
+        f"Read lines: {stats['rows_read']}",
+        f"\nWritten lines: {stats['rows_written']}",
+        f"\nSorted runs: {stats['runs']}",
+    )
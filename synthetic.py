@@ -0,0 +1,234 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cleaning import COMMENT_COLUMNS
+from stations import STATIONS
+from storage import temp_path
+
+# Bumped when the generated data changes, so that saved files are generated again.
+GENERATOR_VERSION = 1
+CHUNK_ROWS = 250_000
+
+MONTHS = [f"{year}-{month:02d}" for year in range(2018, 2025) for month in range(1, 13)]
+
+RAW_COLUMNS = [
+    "Date",
+    "Service",
+    "Departure station",
+    "Arrival station",
+    "Average journey time",
+    "Number of scheduled trains",
+    "Number of cancelled trains",
+    "Cancellation comments",
+    "Number of trains delayed at departure",
+    "Average delay of late trains at departure",
+    "Average delay of all trains at departure",
+    "Departure delay comments",
+    "Number of trains delayed at arrival",
+    "Average delay of late trains at arrival",
+    "Average delay of all trains at arrival",
+    "Arrival delay comments",
+    "Number of trains delayed > 15min",
+    "Average delay of trains > 15min (if competing with flights)",
+    "Number of trains delayed > 30min",
+    "Number of trains delayed > 60min",
+    "Pct delay due to external causes",
+    "Pct delay due to infrastructure",
+    "Pct delay due to traffic management",
+    "Pct delay due to rolling stock",
+    "Pct delay due to station management and equipment reuse",
+    "Pct delay due to passenger handling (crowding, disabled persons, connections)",
+]
+NUMBER_COLUMNS = [
+    column
+    for column in RAW_COLUMNS[4:]
+    if column not in COMMENT_COLUMNS and not column.startswith("Pct")
+]
+PCT_COLUMNS = [column for column in RAW_COLUMNS if column.startswith("Pct")]
+
+# Share of the values made dirty, like in assets/dataset.csv.
+DIRT = {
+    "misspelled": 0.03,  # station and service names
+    "bad date": 0.005,  # other delimiters, "N/A"
+    "missing": 0.02,  # empty numbers
+    "na": 0.01,  # "N/A" instead of a number
+    "negative": 0.005,
+    "comment": 0.03,  # quoted comments, on several lines
+}
+
+COMMENTS = [
+    "Ce mois-ci, l'OD a été touchée par les incidents suivants :\n"
+    "Le 1er : Tempête Carmen\nLe 12 : panne de signalisation",
+    'Mouvement social ; trafic "très perturbé"\nReprise progressive le 15',
+    "Travaux sur la ligne.\nLes 3, 4 et 5 : trains limités",
+    "Obstacle sur la voie",
+]
+
+
+# Departure/arrival pairs of the synthetic network: every station is linked both
+# ways to one of the Paris stations, plus a few direct routes between the others.
+def route_table(seed=0):
+    rng = np.random.default_rng([seed, 0])
+    paris = [station for station in STATIONS if station.startswith("PARIS")]
+    others = [station for station in STATIONS if not station.startswith("PARIS")]
+    pairs = []
+    for station in others:
+        hub = paris[rng.integers(len(paris))]
+        pairs += [(hub, station), (station, hub)]
+    for _ in range(len(others) // 4):
+        dep, arr = rng.choice(len(others), 2, replace=False)
+        pairs.append((others[dep], others[arr]))
+    routes = pd.DataFrame(pairs, columns=["Departure station", "Arrival station"])
+    routes["service"] = np.where(rng.random(len(routes)) < 0.1, 1, 0)
+    routes["journey"] = rng.uniform(60, 420, len(routes))
+    routes["trains"] = rng.uniform(80, 900, len(routes))
+    routes["late"] = rng.beta(2, 6, len(routes))
+    return routes
+
+
+# One misspelling of a name: lower case, a missing letter, two letters swapped,
+# an extra space or a number.
+def misspell(names, rng):
+    names = np.asarray(names, dtype=object)
+    kinds = rng.integers(5, size=len(names))
+    out = names.copy()
+    for i, (name, kind) in enumerate(zip(names, kinds)):
+        j = rng.integers(max(len(name) - 1, 1))
+        if kind == 0:
+            out[i] = name.lower()
+        elif kind == 1:
+            out[i] = name[:j] + name[j + 1 :]
+        elif kind == 2:
+            out[i] = name[:j] + name[j + 1 : j + 2] + name[j : j + 1] + name[j + 2 :]
+        elif kind == 3:
+            out[i] = " " + name + " "
+        else:
+            out[i] = name + " 2"
+    return out
+
+
+# Puts dirt at a random share of the values of a column (as strings when needed).
+def _dirty(values, rng, share, dirt):
+    mask = rng.random(len(values)) < share
+    if mask.any():
+        values = values.astype(object)
+        values[mask] = dirt(values[mask])
+    return values
+
+
+# Raw rows start to start + rows of the synthetic dataset (same schema and kind of
+# dirt as assets/dataset.csv). A chunk only depends on the seed, its start and its
+# size: the same seed always gives the same file.
+def generate(rows, seed=0, start=0, routes=None):
+    if routes is None:
+        routes = route_table(seed)
+    rng = np.random.default_rng([seed, 1, start])
+    route = routes.iloc[rng.integers(len(routes), size=rows)].reset_index(drop=True)
+    noise = rng.uniform(0.8, 1.2, rows)
+
+    scheduled = np.rint(route["trains"].to_numpy() * noise)
+    cancelled = rng.binomial(scheduled.astype("int64"), 0.02)
+    delayed_departure = rng.binomial(scheduled.astype("int64"), route["late"])
+    delayed_arrival = rng.binomial(scheduled.astype("int64"), route["late"] * 1.2)
+    late15 = rng.binomial(delayed_arrival, 0.6)
+    late30 = rng.binomial(late15, 0.5)
+    late60 = rng.binomial(late30, 0.4)
+    late_departure = rng.gamma(2, 6, rows)
+    late_arrival = rng.gamma(3, 7, rows)
+    pcts = rng.dirichlet(np.ones(len(PCT_COLUMNS)), rows) * 100
+
+    csv = pd.DataFrame(
+        {
+            "Date": np.asarray(MONTHS)[rng.integers(len(MONTHS), size=rows)],
+            "Service": np.where(route["service"] == 1, "International", "National"),
+            "Departure station": route["Departure station"].to_numpy(),
+            "Arrival station": route["Arrival station"].to_numpy(),
+            "Average journey time": np.rint(route["journey"].to_numpy() * noise),
+            "Number of scheduled trains": scheduled,
+            "Number of cancelled trains": cancelled.astype("float64"),
+            "Number of trains delayed at departure": delayed_departure.astype(
+                "float64"
+            ),
+            "Average delay of late trains at departure": late_departure,
+            "Average delay of all trains at departure": late_departure
+            * delayed_departure
+            / scheduled.clip(1),
+            "Number of trains delayed at arrival": delayed_arrival.astype("float64"),
+            "Average delay of late trains at arrival": late_arrival,
+            "Average delay of all trains at arrival": late_arrival
+            * delayed_arrival
+            / scheduled.clip(1),
+            "Number of trains delayed > 15min": late15.astype("float64"),
+            "Average delay of trains > 15min (if competing with flights)": late_arrival
+            + 20,
+            "Number of trains delayed > 30min": late30.astype("float64"),
+            "Number of trains delayed > 60min": late60.astype("float64"),
+        }
+    )
+    for i, column in enumerate(PCT_COLUMNS):
+        csv[column] = pcts[:, i]
+
+    for column in ["Service", "Departure station", "Arrival station"]:
+        csv[column] = _dirty(
+            csv[column].to_numpy(), rng, DIRT["misspelled"], lambda v: misspell(v, rng)
+        )
+    csv["Date"] = _dirty(
+        csv["Date"].to_numpy(),
+        rng,
+        DIRT["bad date"],
+        lambda v: np.where(
+            rng.random(len(v)) < 0.5, "N/A", [d.replace("-", "/") for d in v]
+        ),
+    )
+    for column in NUMBER_COLUMNS + PCT_COLUMNS:
+        values = csv[column].to_numpy()
+        values = np.where(rng.random(rows) < DIRT["missing"], np.nan, values)
+        values = np.where(rng.random(rows) < DIRT["negative"], -values, values)
+        csv[column] = _dirty(values, rng, DIRT["na"], lambda v: "N/A")
+    for column in COMMENT_COLUMNS:
+        comments = np.full(rows, None, dtype=object)
+        csv[column] = _dirty(
+            comments,
+            rng,
+            DIRT["comment"],
+            lambda v: np.asarray(COMMENTS, dtype=object)[
+                rng.integers(len(COMMENTS), size=len(v))
+            ],
+        )
+    return csv[RAW_COLUMNS]
+
+
+def dataset_file(directory, rows, seed=0):
+    return Path(directory) / f"synthetic_{rows}_{seed}_v{GENERATOR_VERSION}.csv"
+
+
+# Writes the synthetic dataset of this size in a csv file like assets/dataset.csv,
+# chunk by chunk (the memory used doesn't depend on the number of rows).
+# An existing file of the same size, seed and version is kept.
+def write_dataset(directory, rows, seed=0, chunk_rows=CHUNK_ROWS):
+    path = dataset_file(directory, rows, seed)
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    routes = route_table(seed)
+    tmp = temp_path(path)
+    with open(tmp, "w", encoding="utf-8", newline="") as out:
+        for start in range(0, rows, chunk_rows):
+            chunk = generate(min(chunk_rows, rows - start), seed, start, routes)
+            chunk.to_csv(out, sep=";", index=False, header=start == 0)
+    tmp.replace(path)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic dataset like assets/dataset.csv."
+    )
+    parser.add_argument("rows", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--directory", default="bench_data")
+    args = parser.parse_args()
+    print(write_dataset(args.directory, args.rows, args.seed))
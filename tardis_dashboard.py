@@ -1,15 +1,17 @@
+import json
 import streamlit as st
-import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 import random
-from pathlib import Path
-from dataset import StationData as sdt
-from dataset import Predict as pred
-from dataset import LateData as ld
-from dataset import arrival_station_list as asl
-from dataset import plot_poly_model as ppm
-from planner import planner_page as pp
+from stations import STATIONS
+from storage import data_fingerprint, dataset_available, load_dataset
+from charts import CHART_BACKEND, CHART_BACKENDS, ChartCache
+import metrics
+from metrics import count, span
+
+# The modules of the other pages (dataset.py and its charts, the model registry,
+# the planner) are imported by the functions that use them, the first time their
+# page is visited, and are then kept by the process: the home page doesn't wait
+# for them (see startup.py).
 
 # pct chance to get drapeo on es main page
 
@@ -186,66 +188,15 @@ translations = {
     },
 }
 
-station_list = [
-    "AIX EN PROVENCE TGV",
-    "ANGERS SAINT LAUD",
-    "ANGOULEME",
-    "ANNECY",
-    "ARRAS",
-    "AVIGNON TGV",
-    "BARCELONA",
-    "BELLEGARDE (AIN)",
-    "BESANCON FRANCHE COMTE TGV",
-    "BORDEAUX ST JEAN",
-    "BREST",
-    "CHAMBERY CHALLES LES EAUX",
-    "DIJON VILLE",
-    "DOUAI",
-    "DUNKERQUE",
-    "FRANCFORT",
-    "GENEVE",
-    "GRENOBLE",
-    "ITALIE",
-    "LA ROCHELLE VILLE",
-    "LAUSANNE",
-    "LAVAL",
-    "LE CREUSOT MONTCEAU MONTCHANIN",
-    "LE MANS",
-    "LILLE",
-    "LYON PART DIEU",
-    "MACON LOCHE",
-    "MADRID",
-    "MARNE LA VALLEE",
-    "MARSEILLE ST CHARLES",
-    "METZ",
-    "MONTPELLIER",
-    "MULHOUSE VILLE",
-    "NANCY",
-    "NANTES",
-    "NICE VILLE",
-    "NIMES",
-    "PARIS EST",
-    "PARIS LYON",
-    "PARIS MONTPARNASSE",
-    "PARIS NORD",
-    "PARIS VAUGIRARD",
-    "PERPIGNAN",
-    "POITIERS",
-    "QUIMPER",
-    "REIMS",
-    "RENNES",
-    "SAINT ETIENNE CHATEAUCREUX",
-    "ST MALO",
-    "ST PIERRE DES CORPS",
-    "STRASBOURG",
-    "STUTTGART",
-    "TOULON",
-    "TOULOUSE MATABIAU",
-    "TOURCOING",
-    "TOURS",
-    "VALENCE ALIXAN TGV",
-    "VANNES",
-    "ZURICH",
+station_list = STATIONS
+
+# Columns read by the prediction page, the others are never loaded.
+pred_columns = [
+    "Departure station",
+    "Arrival station",
+    "Average journey time",
+    "Number of scheduled trains",
+    "Number of trains delayed at departure",
 ]
 
 date_list = [
@@ -272,133 +223,177 @@ st.set_page_config(page_title="Train Dashboard", page_icon="🚄", layout="wide"
 lang = st.sidebar.selectbox(
     "Select Language / Choisir la langue", options=["en", "fr", "es"], index=1
 )
-data = pd.DataFrame(
-    {
-        translations[lang]["col1"]: [
-            translations[lang]["noé"],
-            translations[lang]["lucas"],
-            translations[lang]["marc"],
-            translations[lang]["pavel"],
-            translations[lang]["ugo"],
-            translations[lang]["nolhan"],
-            translations[lang]["juan"],
-            translations[lang]["titouan"],
-            translations[lang]["groot"],
-            translations[lang]["steve jobs"],
-        ],
-        translations[lang]["col2"]: [
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-            "⭐" * random.randint(1, 3),
-        ],
-        translations[lang]["col3"]: [
-            "⭐" * 5,
-            "⭐" * 5,
-            "⭐" * 5,
-            "⭐" * 5,
-            "⭐" * 5,
-            "⭐" * 5,
-            "⭐" * 5,
-            "⭐" * 5,
-            "⭐" * 5,
-            "⭐" * 5,
-        ],
-        translations[lang]["col4"]: [
-            translations[lang]["com"]["1"],
-            translations[lang]["com"]["2"],
-            translations[lang]["com"]["3"],
-            translations[lang]["com"]["4"],
-            translations[lang]["com"]["5"],
-            translations[lang]["com"]["6"],
-            translations[lang]["com"]["7"],
-            translations[lang]["com"]["8"],
-            translations[lang]["com"]["9"],
-            translations[lang]["com"]["10"],
-        ],
-    }
-)
 
-data.index += 1
-
-dataes = pd.DataFrame(
-    {
-        translations[lang]["col1"]: [
-            translations[lang]["noé"],
-            translations[lang]["lucas"],
-            translations[lang]["marc"],
-            translations[lang]["pavel"],
-            translations[lang]["ugo"],
-            translations[lang]["nolhan"],
-            translations[lang]["juan"],
-            translations[lang]["titouan"],
-            translations[lang]["groot"],
-            translations[lang]["steve jobs"],
-        ],
-        translations[lang]["col2"]: [
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-            "🫒" * random.randint(1, 3),
-        ],
-        translations[lang]["col3"]: [
-            "🫒" * 5,
-            "🫒" * 5,
-            "🫒" * 5,
-            "🫒" * 5,
-            "🫒" * 5,
-            "🫒" * 5,
-            "🫒" * 5,
-            "🫒" * 5,
-            "🫒" * 5,
-            "🫒" * 5,
-        ],
-        translations[lang]["col4"]: [
-            translations[lang]["com"]["1"],
-            translations[lang]["com"]["2"],
-            translations[lang]["com"]["3"],
-            translations[lang]["com"]["4"],
-            translations[lang]["com"]["5"],
-            translations[lang]["com"]["6"],
-            translations[lang]["com"]["7"],
-            translations[lang]["com"]["8"],
-            translations[lang]["com"]["9"],
-            translations[lang]["com"]["10"],
-        ],
-    }
-)
+# Only checks that the cleaned dataset exists, each page loads the columns
+# and the months it needs with load_data.
+has_dataset = dataset_available()
 
-dataes.index += 1
 
-# Attempts to load the cleaned CSV dataset from disk.
-# Handles multiple cases: missing file, empty file, parsing errors, or unexpected exceptions.
-file_path = Path("cleaned_dataset.csv")
+# Version of the cleaned data: the content hashes of the months of the store, or
+# the date and size of the csv file. Every cache below is keyed on it, so they
+# are all refreshed as soon as the data changes.
+def data_version():
+    return data_fingerprint()
 
-try:
-    if file_path.exists() and file_path.stat().st_size > 0:
-        csv = pd.read_csv(file_path)
-    else:
-        csv = None
-except pd.errors.ParserError:
-    csv = None
-    st.error(
-        "There was an error parsing the dataset. Please ensure 'cleaned_dataset.csv' is correctly formatted."
+
+# The dataset, the monthly totals, the route index and the model registry are
+# loaded once per server process and shared by every session, they are never
+# modified. Only the last two versions of the data are kept.
+# The dataset is memory-mapped (see storage.load_mapped): the server processes of
+# a deployment share its pages.
+@st.cache_resource(max_entries=2, show_spinner=False)
+def shared_dataset(version, columns):
+    with span("load dataset", columns=list(columns)):
+        return load_dataset(list(columns), mapped=True)
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def shared_totals(version):
+    from cube import load_cube
+
+    with span("load totals"):
+        return load_cube()
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def shared_routes(version):
+    from routes import RouteIndex
+
+    csv = shared_dataset(version, tuple(pred_columns))
+    with span("RouteIndex"):
+        return RouteIndex(csv)
+
+
+@st.cache_resource(show_spinner=False)
+def shared_registry():
+    from registry import ModelRegistry
+
+    return ModelRegistry()
+
+
+# Rendered charts of every session (see charts.py).
+@st.cache_resource(show_spinner=False)
+def shared_charts():
+    return ChartCache()
+
+
+# Prometheus endpoint and JSON lines file of the metrics, if the deployment asks
+# for them (see metrics.py), started once per server process.
+@st.cache_resource(show_spinner=False)
+def shared_metrics():
+    return metrics.start()
+
+
+shared_metrics()
+
+
+# Loads the cleaned dataset (parquet store, or the csv file if there is none).
+# Handles multiple cases: missing dataset, parsing errors, or unexpected exceptions.
+def load_data(columns):
+    try:
+        return shared_dataset(data_version(), tuple(columns))
+    except pd.errors.ParserError:
+        st.error(
+            "There was an error parsing the dataset. Please ensure 'cleaned_dataset.csv' is correctly formatted."
+        )
+    except Exception as e:
+        st.error(f"An unexpected error occurred while loading the dataset: {str(e)}")
+    return None
+
+
+# Loads the monthly totals of the journey data page (see cube.py), they are only
+# computed again when the cleaned dataset changed.
+def load_totals():
+    try:
+        return shared_totals(data_version())
+    except Exception as e:
+        st.error(f"An unexpected error occurred while loading the dataset: {str(e)}")
+    return None
+
+
+# Users' reviews of the page in this language, with random ratings before SNCP
+# (olives instead of stars in Spanish). Built on the first visit of the page,
+# then kept by the process.
+@st.cache_data(show_spinner=False)
+def reviews(lang):
+    text = translations[lang]
+    symbol = "🫒" if lang == "es" else "⭐"
+    people = ["noé", "lucas", "marc", "pavel", "ugo", "nolhan", "juan", "titouan"]
+    people += ["groot", "steve jobs"]
+    df = pd.DataFrame(
+        {
+            text["col1"]: [text[name] for name in people],
+            text["col2"]: [symbol * random.randint(1, 3) for _ in people],
+            text["col3"]: [symbol * 5 for _ in people],
+            text["col4"]: [text["com"][str(i)] for i in range(1, len(people) + 1)],
+        }
     )
-except Exception as e:
-    csv = None
-    st.error(f"An unexpected error occurred while loading the dataset: {str(e)}")
+    df.index += 1
+    return df
+
+
+# Results computed for some inputs are kept for every session, up to max_entries
+# of them (the least recently used are dropped). Their bodies only run on a miss,
+# the callers count the requests.
+# Station and delay totals of a date range.
+@st.cache_data(max_entries=64, show_spinner=False)
+def journey_totals(version, dates):
+    from dataset import LateData as ld
+    from dataset import StationData as sdt
+
+    count("cache_misses", cache="journey_totals")
+    totals = shared_totals(version)
+    with span("StationData", dates=dates):
+        data = sdt.from_cube(totals, list(dates))
+    with span("LateData", dates=dates):
+        late_data = ld.from_cube(totals, list(dates))
+    return data, late_data
+
+
+# Prediction of a route: averages, fitted model (with the degree chosen for the
+# route in the registry) and 95% prediction interval of the delayed trains.
+# Shared by the sessions like the dataset and never modified: a cache hit copies
+# nothing. The rows of the route are not kept, they are a view of the mapped
+# dataset taken again from the route index when the chart is drawn.
+@st.cache_resource(max_entries=256, show_spinner=False)
+def route_prediction(version, departure, arrival):
+    from dataset import Predict as pred
+    from registry import DELAY_MODEL
+
+    count("cache_misses", cache="route_prediction")
+    csv = shared_dataset(version, tuple(pred_columns))
+    routes = shared_routes(version)
+    route = f"{departure} - {arrival}"
+    with span("Predict", route=route):
+        predict = pred(csv, [arrival], [departure], routes)
+        nb_trains = predict.moy("Number of scheduled trains")
+    with span("load models"):
+        models = shared_registry().get(*DELAY_MODEL, csv=csv)
+    degree = models.degree(departure, arrival)
+    with span("fit", route=route, degree=degree):
+        fit = predict.fit(*DELAY_MODEL[:2], degree, models=models)
+        low, high = fit.interval(nb_trains)
+    return {
+        "average": predict.moy("Average journey time"),
+        "nb_trains": nb_trains,
+        "degree": degree,
+        "fit": fit,
+        "low": max(low[0], 0),
+        "high": max(high[0], 0),
+    }
+
+
+# Displays the chart of this key, draw(backend) is only called if the chart
+# wasn't rendered before for the same inputs (see CHART_BACKEND in charts.py).
+def show_chart(key, draw):
+    fmt = CHART_BACKENDS[CHART_BACKEND]
+    image = shared_charts().render(key, lambda: draw(CHART_BACKEND), fmt)
+    if image is None:
+        return
+    if fmt == "vega":
+        st.vega_lite_chart(json.loads(image), use_container_width=True)
+    else:
+        st.image(image, use_container_width=True)
 
 
 # Use session state to track which subpage the user is currently viewing.
@@ -414,7 +409,7 @@ def go_to(page_name):
 # Displays train delay charts and statistics for selected stations and dates.
 def render_subpage_data():
     st.title(translations[lang]["journey_data"])
-    if csv is None:
+    if not has_dataset:
         st.error(translations[lang]["dataset_missing"])
         return
 
@@ -426,21 +421,35 @@ def render_subpage_data():
     )
     # Station selection
     choices = st.multiselect(translations[lang]["select_stations"], station_list)
-    dates = [start_date, end_date]
+    dates = (start_date, end_date)
+    if load_totals() is None:
+        st.error(translations[lang]["dataset_missing"])
+        return
     try:
         # Prepare transformed data for plotting
-        data = sdt(csv, dates)
-        late_data = ld(csv, dates)
+        version = data_version()
+        count("cache_requests", cache="journey_totals")
+        data, late_data = journey_totals(version, dates)
 
         if len(choices) > 10 or len(choices) == 0:
             st.warning(translations[lang]["number_station_warning"])
         else:
             # Display plots
-            st.pyplot(data.station_scheduled_late(choices, lang))
-            st.pyplot(late_data.late_train_data(choices, lang))
+            inputs = (version, dates, tuple(choices), lang)
+            show_chart(
+                ("station_scheduled_late",) + inputs,
+                lambda backend: data.station_scheduled_late(choices, lang, backend),
+            )
+            show_chart(
+                ("late_train_data",) + inputs,
+                lambda backend: late_data.late_train_data(choices, lang, backend),
+            )
             # If exactly one station is selected, show causes of delays
             station = st.selectbox(translations[lang]["select_station"], choices)
-            st.pyplot(late_data.late_train_pct([station], lang))
+            show_chart(
+                ("late_train_pct", version, dates, station, lang),
+                lambda backend: late_data.late_train_pct([station], lang, backend),
+            )
     except Exception as e:
         st.error(translations[lang]["error_processing_data"].format(err=str(e)))
     st.button(translations[lang]["return_home"], on_click=go_to, args=("home",))
@@ -448,29 +457,29 @@ def render_subpage_data():
 
 # Provides predictions about train delays based on departure and arrival stations.
 def render_subpage_pred():
+    from dataset import arrival_station_list as asl
+    from dataset import plot_poly_model as ppm
+
     st.title(translations[lang]["predictions"])
+    csv = load_data(pred_columns) if has_dataset else None
     if csv is None:
         st.error(translations[lang]["dataset_missing"])
         return
     try:
+        # Arrival stations of each departure (shared route index)
+        routes = shared_routes(data_version())
         st.write(translations[lang]["predictions_welcome"])
         departure = st.selectbox(translations[lang]["select_departure"], station_list)
-        arrival = st.selectbox(
-            translations[lang]["select_arrival"], asl(csv, [departure])
-        )
-        predict = pred(csv, [departure], [arrival])
-
-        average = predict.moy("Average journey time")
-        nb_trains = predict.moy("Number of scheduled trains")
-        model = predict.model(
-            "Number of scheduled trains", "Number of trains delayed at departure"
-        )
-        r2 = predict.r2(
-            "Number of scheduled trains", "Number of trains delayed at departure"
-        )
-        rmse = predict.rmse(
-            "Number of scheduled trains", "Number of trains delayed at departure"
-        )
+        with span("arrival_station_list", departure=departure):
+            arrivals = asl(csv, [departure], routes)
+        arrival = st.selectbox(translations[lang]["select_arrival"], arrivals)
+        count("cache_requests", cache="route_prediction")
+        prediction = route_prediction(data_version(), departure, arrival)
+        average = prediction["average"]
+        nb_trains = prediction["nb_trains"]
+        fit = prediction["fit"]
+        model, r2 = fit.model, fit.r2
+        low, high = prediction["low"], prediction["high"]
 
         # Display prediction statistics
         st.subheader(translations[lang]["average_travel_time"])
@@ -481,7 +490,7 @@ def render_subpage_pred():
             f"""
         - {translations[lang]["average_travel_time"]} <span style='color:#2171b5'><b>{int(hours)} h {int(minutes)} min</b></span>.
         - <span style='color:#2171b5'><b>{int(nb_trains)}</b></span> {translations[lang]["scheduled_trains"]}, 
-        <span style='color:#2171b5'><b>{int(model(nb_trains))}</b></span> (±<span style='color:#2171b5'><b>{int(rmse)}</b></span>) {translations[lang]["delayed_trains"]}.
+        <span style='color:#2171b5'><b>{int(model(nb_trains))}</b></span> (<span style='color:#2171b5'><b>{int(low)}</b></span> - <span style='color:#2171b5'><b>{int(high)}</b></span>) {translations[lang]["delayed_trains"]}.
         """,
             unsafe_allow_html=True,
         )
@@ -496,14 +505,17 @@ def render_subpage_pred():
             st.warning(translations[lang]["accuracy_warning"])
 
         # Plot the model selected before
-        st.pyplot(
-            ppm(
-                predict.csv,
+        show_chart(
+            ("plot_poly_model", data_version(), departure, arrival, lang),
+            lambda backend: ppm(
+                routes.select(csv, [departure], [arrival]),
                 "Number of scheduled trains",
                 "Number of trains delayed at departure",
-                3,
+                prediction["degree"],
                 lang,
-            )
+                fit,
+                backend,
+            ),
         )
 
     except Exception as e:
@@ -518,10 +530,7 @@ def render_subpage_user():
     st.title(translations[lang]["users_reviews"])
     st.write(translations[lang]["users_reviews_welcome"])
     # Print
-    if lang != "es":
-        st.dataframe(data)
-    else:
-        st.dataframe(dataes)
+    st.dataframe(reviews(lang))
     st.button(translations[lang]["return_home"], on_click=go_to, args=("home",))
     st.markdown(
         f"<br><br><br><br><br><br><br><br><br><h5 style='text-align:center;'>{translations[lang]['credit']}</h5>",
@@ -533,7 +542,7 @@ def render_subpage_user():
 def home():
     st.title(translations[lang]["welcome_home"])
 
-    if csv is None:
+    if not has_dataset:
         st.warning(translations[lang]["dataset_missing"])
         return
 
@@ -585,7 +594,37 @@ def main():
     elif st.session_state.page == "pred":
         render_subpage_pred()
     elif st.session_state.page == "planner":
+        from planner import planner_page as pp
+
         pp(lang)
 
 
-main()
+# Breakdown of the rerun in the sidebar (spans in order, with their inputs, and
+# counters), shown when TARDIS_DEBUG_PANEL is set.
+def debug_panel(rerun):
+    with st.sidebar.expander("Debug"):
+        st.write(f"Rerun of {rerun.page}: {rerun.seconds * 1000:.1f} ms")
+        if rerun.spans:
+            st.dataframe(
+                pd.DataFrame(
+                    {
+                        "span": [s["name"] for s in rerun.spans],
+                        "ms": [s["seconds"] * 1000 for s in rerun.spans],
+                        "inputs": [
+                            ", ".join(f"{k}={v}" for k, v in s["tags"].items())
+                            for s in rerun.spans
+                        ],
+                    }
+                ),
+                hide_index=True,
+            )
+        for name, value in rerun.counters.items():
+            st.write(f"{name}: {value:g}")
+
+
+# Every rerun is timed, with the spans of the page (see metrics.py).
+with metrics.rerun(st.session_state.page, lang=lang) as rerun:
+    main()
+
+if metrics.DEBUG_PANEL:
+    debug_panel(rerun)
@@ -0,0 +1,48 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from cleaning import clean  # noqa: E402
+from storage import compact  # noqa: E402
+
+TYPE1 = "Number of scheduled trains"
+TYPE2 = "Number of trains delayed at departure"
+
+
+# assets/dataset.csv cleaned like incremental.py does, as a compact frame.
+@pytest.fixture(scope="session")
+def cleaned():
+    raw = pd.read_csv(ROOT / "assets" / "dataset.csv", sep=";", dtype=str)
+    return compact(clean(raw)[0])
+
+
+# The dataset module of the dashboard. installer.sh converts tardis_model.ipynb
+# into dataset.py; without it, the notebook is converted in a temporary directory.
+@pytest.fixture(scope="session")
+def dataset(tmp_path_factory):
+    if not (ROOT / "dataset.py").exists():
+        nbconvert = pytest.importorskip("nbconvert")
+        notebook = str(ROOT / "tardis_model.ipynb")
+        source, _ = nbconvert.PythonExporter().from_filename(notebook)
+        directory = tmp_path_factory.mktemp("dataset")
+        (directory / "dataset.py").write_text(source, encoding="utf-8")
+        sys.path.insert(0, str(directory))
+    return importlib.import_module("dataset")
+
+
+# Rows of every route with both columns set, in the order of the frame (the
+# rows Predict fits), for the routes with at least min_rows of them.
+def route_rows(csv, min_rows=1):
+    route = ["Departure station", "Arrival station"]
+    rows = csv.dropna(subset=route + [TYPE1, TYPE2])
+    for pair, group in rows.groupby(route, observed=True, sort=True):
+        if len(group) >= min_rows:
+            x = group[TYPE1].to_numpy(dtype="float64")
+            y = group[TYPE2].to_numpy(dtype="float64")
+            yield pair, x, y
@@ -0,0 +1,84 @@
+import json
+from urllib.parse import urlencode
+
+import numpy as np
+import pytest
+from conftest import TYPE1, TYPE2
+from tornado.testing import AsyncHTTPTestCase
+
+from cleaning import CanonicalCache
+from incremental import update
+
+BUSY = ("PARIS EST", "REIMS")
+# cut to 3 rows: 2 to train, 1 to test (no R²)
+SHORT = ("PARIS VAUGIRARD", "BORDEAUX ST JEAN")
+# rows kept without the counts of the model
+EMPTY = ("TOURCOING", "MARSEILLE ST CHARLES")
+
+
+# Store of assets/dataset.csv (cleaned once more) with the SHORT and EMPTY routes.
+@pytest.fixture(scope="module")
+def store(tmp_path_factory, cleaned):
+    csv = cleaned.copy()
+
+    def route(departure, arrival):
+        return (csv["Departure station"] == departure) & (
+            csv["Arrival station"] == arrival
+        )
+
+    short = route(*SHORT)
+    csv = csv[~short | (short.cumsum() <= 3)]
+    csv.loc[route(*EMPTY), [TYPE1, TYPE2]] = np.nan
+    csv["Date"] = csv["Date"].dt.strftime("%Y-%m")
+    directory = tmp_path_factory.mktemp("api")
+    csv.to_csv(directory / "raw.csv", sep=";", index=False)
+    update([directory / "raw.csv"], directory / "cleaned", cache=CanonicalCache(None))
+    return directory
+
+
+@pytest.fixture(scope="class")
+def application(request, dataset, store):
+    from api import Analytics, make_app
+
+    analytics = Analytics(store / "cleaned", store / "cleaned.csv", store / "models")
+    request.cls.application = make_app(analytics)
+
+
+def strict(constant):
+    raise ValueError(f"{constant} is not JSON")
+
+
+@pytest.mark.usefixtures("application")
+class TestPredict(AsyncHTTPTestCase):
+    def get_app(self):
+        return self.application
+
+    def predict(self, route):
+        query = urlencode({"departure": route[0], "arrival": route[1]})
+        response = self.fetch("/predict?" + query)
+        return response.code, json.loads(response.body, parse_constant=strict)
+
+    def test_route(self):
+        code, body = self.predict(BUSY)
+        assert code == 200
+        assert (body["departure"], body["arrival"]) == BUSY
+        for name in ["scheduled trains", "delayed at departure", "r2", "rmse"]:
+            assert isinstance(body[name], float)
+        assert body["low"] <= body["delayed at departure"] <= body["high"]
+
+    # no test R² with a single test row: null, not NaN
+    def test_short_route(self):
+        code, body = self.predict(SHORT)
+        assert code == 200
+        assert body["r2"] is None
+        assert isinstance(body["delayed at departure"], float)
+
+    def test_route_without_counts(self):
+        code, body = self.predict(EMPTY)
+        assert code == 422
+        assert body["status"] == 422
+
+    def test_unknown_route(self):
+        code, body = self.predict((BUSY[0], "NOWHERE"))
+        assert code == 404
+        assert body["status"] == 404
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+from conftest import ROOT
+
+import incremental
+from cleaning import CanonicalCache
+from cube import Cube, load_cube
+from incremental import export, partition_of, update
+from storage import UNDATED, _open_mapped, load_mapped
+
+
+# assets/dataset.csv split in two sources: every month but the last full one,
+# and that month with a few rows without a date.
+def split_sources(directory):
+    raw = pd.read_csv(ROOT / "assets" / "dataset.csv", sep=";", dtype=str)
+    month = partition_of(raw["Date"])
+    counts = month[month != UNDATED].value_counts()
+    last = counts[counts > 10].index.max()
+    old, new = directory / "old.csv", directory / "new.csv"
+    raw[month != last].to_csv(old, sep=";", index=False)
+    rows = raw[month == last].copy()
+    rows.iloc[:3, rows.columns.get_loc("Date")] = None
+    rows.to_csv(new, sep=";", index=False)
+    return old, new
+
+
+def outputs(store, output):
+    export(store, output)
+    load_cube(store, output)
+    load_mapped(store=store, csv_file=output)
+    return {
+        "csv": output.read_bytes(),
+        "cube": Cube.load(store / "cube.npz"),
+        "mapped": _open_mapped(store / "dataset.arrow"),
+    }
+
+
+# A source with only a new month: old.csv is not read again, and the csv file,
+# the cube and the mapped file updated from their previous version are the ones
+# written from the whole store.
+def test_new_month_matches_full_build(tmp_path, monkeypatch):
+    old, new = split_sources(tmp_path)
+    store, output = tmp_path / "cleaned", tmp_path / "cleaned.csv"
+    cache = CanonicalCache(None)
+    update([old], store, cache=cache)
+    outputs(store, output)
+
+    reads = []
+    read_raw = incremental.read_raw
+
+    def spy(sources, *args, **kwargs):
+        reads.extend(str(source) for source in sources)
+        return read_raw(sources, *args, **kwargs)
+
+    monkeypatch.setattr(incremental, "read_raw", spy)
+    cleaned = update([old, new], store, cache=cache)
+    assert len(cleaned) == 2
+    assert str(old) not in reads
+    updated = outputs(store, output)
+
+    for name in ["cube.npz", "dataset.arrow", "export.json"]:
+        (store / name).unlink()
+    output.unlink()
+    full = outputs(store, output)
+
+    assert updated["csv"] == full["csv"]
+    assert list(updated["cube"].months) == list(full["cube"].months)
+    for by, sums in full["cube"].sums.items():
+        np.testing.assert_array_equal(updated["cube"].keys[by], full["cube"].keys[by])
+        np.testing.assert_allclose(updated["cube"].sums[by], sums, rtol=1e-12)
+    assert updated["mapped"].schema.equals(full["mapped"].schema, check_metadata=True)
+    for column in full["mapped"].column_names:
+        np.testing.assert_array_equal(
+            updated["mapped"].column(column).to_numpy(),
+            full["mapped"].column(column).to_numpy(),
+        )
@@ -0,0 +1,16 @@
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+
+
+# A second process started on the same port runs without the endpoint and logs
+# why, instead of failing with "address in use".
+def test_start_on_a_used_port(caplog):
+    server = ThreadingHTTPServer(("", 0), BaseHTTPRequestHandler)
+    try:
+        with caplog.at_level(logging.WARNING, logger="tardis.metrics"):
+            assert metrics.start(port=server.server_port, path=None) is None
+        assert "not started" in caplog.text
+    finally:
+        server.server_close()
@@ -0,0 +1,36 @@
+import warnings
+
+import numpy as np
+import pytest
+from conftest import TYPE1, TYPE2, route_rows
+from sklearn.metrics import mean_squared_error, r2_score
+
+from regression import TRAIN_SHARE
+from routes import RouteIndex
+
+
+# Predict.model, r2 and rmse of every route, with and without the route index:
+# np.polyfit on the first 80% of the rows of the route, sklearn's R² and RMSE on
+# the others.
+@pytest.mark.parametrize("degree", [1, 3])
+@pytest.mark.parametrize("indexed", [False, True])
+def test_predict_matches_polyfit(dataset, cleaned, degree, indexed):
+    routes = RouteIndex(cleaned) if indexed else None
+    checked = 0
+    for (departure, arrival), x, y in route_rows(cleaned):
+        predict = dataset.Predict(cleaned, [arrival], [departure], routes)
+        split = int(len(x) * TRAIN_SHARE)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", np.exceptions.RankWarning)
+            coeffs = np.polyfit(x[:split], y[:split], degree)
+        np.testing.assert_allclose(
+            predict.model(TYPE1, TYPE2, degree).coeffs, coeffs, rtol=1e-12
+        )
+        predicted = np.polyval(coeffs, x[split:])
+        r2 = r2_score(y[split:], predicted)
+        rmse = np.sqrt(mean_squared_error(y[split:], predicted))
+        assert predict.r2(TYPE1, TYPE2, degree) == pytest.approx(r2, rel=1e-10)
+        assert predict.rmse(TYPE1, TYPE2, degree) == pytest.approx(rmse, rel=1e-10)
+        checked += 1
+    route = ["Departure station", "Arrival station"]
+    assert checked == cleaned.groupby(route, observed=True).ngroups
@@ -0,0 +1,190 @@
+import warnings
+
+import numpy as np
+import pytest
+from conftest import TYPE1, TYPE2, route_rows
+from sklearn.metrics import mean_squared_error, r2_score
+
+from regression import (
+    CV_FOLDS,
+    CV_START,
+    CV_STEP,
+    DEGREES,
+    LINEAR,
+    TRAIN_SHARE,
+    OnlineModels,
+    batch_polyfit,
+    batch_scores,
+    bootstrap,
+    bootstrap_interval,
+    fit_routes,
+    route_arrays,
+    select_degrees,
+)
+from storage import UNDATED, is_undated
+
+
+@pytest.mark.parametrize("degree", [1, 2, 3])
+def test_batch_polyfit_matches_polyfit(cleaned, degree):
+    _, x, y, n = route_arrays(cleaned, TYPE1, TYPE2)
+    mask = np.arange(x.shape[1]) < n[:, None]
+    coeffs = batch_polyfit(x, y, mask, degree)
+    for i in np.flatnonzero(n > degree + 1):
+        expected = np.polyfit(x[i, : n[i]], y[i, : n[i]], degree)
+        np.testing.assert_allclose(
+            np.polyval(coeffs[i], x[i, : n[i]]),
+            np.polyval(expected, x[i, : n[i]]),
+            rtol=1e-10,
+            atol=1e-9,
+        )
+
+
+# Same model, R² and RMSE as Predict.fit: np.polyfit on the first 80% of the
+# rows of the route, sklearn's metrics on the others.
+@pytest.mark.parametrize("degree", [1, 3])
+def test_fit_routes_matches_predict(cleaned, degree):
+    table = fit_routes(cleaned, TYPE1, TYPE2, degree)
+    table = table.set_index(["Departure station", "Arrival station"])
+    powers = [f"x^{power}" for power in range(degree, -1, -1)]
+    checked = 0
+    for pair, x, y in route_rows(cleaned, min_rows=10):
+        split = int(len(x) * TRAIN_SHARE)
+        coeffs = np.polyfit(x[:split], y[:split], degree)
+        predicted = np.polyval(coeffs, x[split:])
+        row = table.loc[pair]
+        assert row["n"] == len(x)
+        np.testing.assert_allclose(
+            np.polyval(row[powers].to_numpy(dtype="float64"), x),
+            np.polyval(coeffs, x),
+            rtol=1e-10,
+            atol=1e-9,
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            r2 = r2_score(y[split:], predicted)
+        assert row["r2"] == pytest.approx(r2, rel=1e-10, abs=1e-10)
+        rmse = np.sqrt(mean_squared_error(y[split:], predicted))
+        assert row["rmse"] == pytest.approx(rmse, rel=1e-10, abs=1e-10)
+        checked += 1
+    assert checked > 50
+
+
+# Rolling origin cross validation written route by route with np.polyfit.
+@pytest.mark.filterwarnings("ignore::numpy.exceptions.RankWarning")
+def test_select_degrees_matches_polyfit(cleaned):
+    table = select_degrees(cleaned, TYPE1, TYPE2, n_jobs=1)
+    table = table.set_index(["Departure station", "Arrival station"])
+    checked = 0
+    for pair, x, y in route_rows(cleaned):
+        n = len(x)
+        errors = {degree: [] for degree in DEGREES}
+        for k in range(CV_FOLDS):
+            origin = int(np.floor(n * (CV_START + k * CV_STEP)))
+            end = (
+                n
+                if k == CV_FOLDS - 1
+                else int(np.floor(n * (CV_START + (k + 1) * CV_STEP)))
+            )
+            if origin <= max(DEGREES) or end <= origin:
+                continue
+            for degree in DEGREES:
+                coeffs = np.polyfit(x[:origin], y[:origin], degree)
+                errors[degree] += list(
+                    y[origin:end] - np.polyval(coeffs, x[origin:end])
+                )
+        row = table.loc[pair]
+        if not errors[LINEAR]:
+            assert row["degree"] == LINEAR
+            continue
+        rmse = {d: np.sqrt(np.mean(np.square(e))) for d, e in errors.items()}
+        for degree in DEGREES:
+            assert row[f"cv {degree}"] == pytest.approx(rmse[degree], rel=1e-6)
+        assert row["degree"] == min(DEGREES, key=lambda d: rmse[d])
+        checked += 1
+    assert checked > 50
+
+
+# Every resample of the bootstrap is the np.polyfit of the fitted values plus
+# resampled residuals, and the interval is the percentiles of their predictions.
+@pytest.mark.parametrize("degree", [1, 3])
+def test_bootstrap_matches_polyfit(cleaned, degree):
+    pair, x, y = max(route_rows(cleaned), key=lambda route: len(route[1]))
+    coeffs = np.polyfit(x, y, degree)
+    draws = 50
+    samples, noise = bootstrap(x, y, degree, coeffs, draws=draws, seed=1)
+
+    fitted = np.polyval(coeffs, x)
+    residuals = (y - fitted - (y - fitted).mean()) * np.sqrt(
+        len(x) / (len(x) - degree - 1)
+    )
+    rng = np.random.default_rng(1)
+    resampled = fitted + residuals[rng.integers(0, len(x), size=(draws, len(x)))]
+    expected_noise = residuals[rng.integers(0, len(x), size=draws)]
+    np.testing.assert_allclose(noise, expected_noise)
+    for sample, y_sample in zip(samples, resampled):
+        np.testing.assert_allclose(
+            np.polyval(sample, x),
+            np.polyval(np.polyfit(x, y_sample, degree), x),
+            rtol=1e-7,
+            atol=1e-6,
+        )
+
+    at = np.array([x.min(), x.mean(), x.max()])
+    low, high = bootstrap_interval(samples, noise, at, level=0.9)
+    values = np.array([np.polyval(sample, at) for sample in samples]) + noise[:, None]
+    np.testing.assert_allclose(low, np.percentile(values, 5, axis=0))
+    np.testing.assert_allclose(high, np.percentile(values, 95, axis=0))
+
+
+# After adding every month, removing the first 12 and adding one again, the sums
+# give the models of np.polyfit on the rows of the window, undated rows included.
+@pytest.mark.parametrize("degree", [1, 3])
+def test_online_models_match_polyfit(cleaned, degree):
+    month = cleaned["Date"].dt.strftime("%Y-%m")
+    models = OnlineModels(TYPE1, TYPE2, degree)
+    added = models.add(cleaned)
+    assert UNDATED in added
+    removed = [m for m in added if not is_undated(m)][:12]
+    for name in removed:
+        models.remove(name)
+    models.add(cleaned[month == added[20]])
+    with pytest.raises(ValueError):
+        models.remove(UNDATED)
+
+    window = cleaned[~month.isin(removed)]
+    table = models.fit().set_index(["Departure station", "Arrival station"])
+    checked = 0
+    for pair, x, y in route_rows(window):
+        row = table.loc[pair]
+        assert row["n"] == len(x)
+        if len(np.unique(x)) <= degree + 1:
+            continue
+        expected = np.polyfit(x, y, degree)
+        coeffs = row[[f"x^{p}" for p in range(degree, -1, -1)]].to_numpy(float)
+        np.testing.assert_allclose(
+            np.polyval(coeffs, x), np.polyval(expected, x), rtol=1e-9, atol=1e-8
+        )
+        residual = y - np.polyval(expected, x)
+        assert row["rmse"] == pytest.approx(np.sqrt(np.mean(residual**2)), abs=1e-8)
+        assert row["r2"] == pytest.approx(
+            r2_score(y, np.polyval(expected, x)), abs=1e-9
+        )
+        checked += 1
+    assert checked > 50
+
+
+# A route with a constant target is fitted exactly: R² is 1 as with batch_scores
+# and sklearn, not nan.
+@pytest.mark.parametrize("degree", [1, 3])
+def test_online_models_constant_target(cleaned, degree):
+    pair, x, y = next(route_rows(cleaned, 20))
+    csv = cleaned.copy()
+    route = (csv["Departure station"] == pair[0]) & (csv["Arrival station"] == pair[1])
+    csv.loc[route & csv[TYPE2].notna(), TYPE2] = 7
+    models = OnlineModels(TYPE1, TYPE2, degree)
+    models.add(csv)
+    row = models.fit().set_index(["Departure station", "Arrival station"]).loc[pair]
+    constant = np.full(len(x), 7.0)
+    r2, rmse = batch_scores(constant[None], constant[None], np.ones((1, len(x)), bool))
+    assert row["r2"] == r2[0] == r2_score(constant, constant) == 1.0
+    assert row["rmse"] == rmse[0] == 0.0